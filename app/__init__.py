@@ -1,25 +1,101 @@
+import math
 import os
-from flask import Flask, request, abort, jsonify
+import random
+import time
+from datetime import datetime
+from flask import (Flask, Response, request, abort, g,
+                   stream_with_context)
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
+from itsdangerous import BadSignature, TimestampSigner
 # from flask_cors import CORS
 
 from app.models import db, Actor, Movie, Genre
-from app.auth import requires_auth, AuthError
+from app.notifications import listener, recent_writers, table_versions
+from app.routing import get_replicas
+from app.cache import ResponseCache
+from app.compression import Compression
+from app.serialization import JSONEncoder, dumps, jsonify
+from app.search import FULL_TEXT_MATCHES, full_text_search, fuzzy_lookup
+from app.bulk import (parse_items, is_id, create_rows, patch_rows,
+                      delete_rows)
+from app.auth import (requires_auth, has_permission, token_subject,
+                      AuthError, jwks_store, jwks_refresher, token_cache)
+
+
+# the cookie pinning the clients which just wrote to the primary
+REPLICA_COOKIE = 'read_primary'
 
 
 # APP FACTORY ----------------------------------------------------------
-def create_app(production=False):
+def create_app(production=False, testing=False):
     # create and configure the app
     app = Flask(__name__)
     if production:
         app.config.from_object('app.config.Production')
+    elif testing:
+        app.config.from_object('app.config.Testing')
     else:
         app.config.from_object('app.config.Config')
+    if not app.secret_key:
+        raise RuntimeError('SECRET_KEY must be set: the dynos check each '
+                           "other's signed cookies with it.")
+    # ISO 8601 dates, whichever encoder serializes the responses
+    app.json_encoder = JSONEncoder
     db.init_app(app)
     migrate = Migrate(app, db)
+    compression = Compression(app)
     # CORS(app)
 
+    # download the JWKS now, before gunicorn forks the workers, and keep it
+    # current in the background so that requests never wait for Auth0
+    if app.config['JWKS_REFRESH']:
+        if not jwks_store.warm_up():
+            app.logger.warning('Unable to download the JWKS, retrying in the '
+                               'background.')
+        jwks_refresher.start()
+
+    # the table versions of the response cache follow the notifications of
+    # the primary, listened to by each worker
+    @app.before_request
+    def listen():
+        listener.start(db.get_engine(app))
+
+    # the reads are sent to a random replica, but those of the clients
+    # which wrote too recently for the replicas to have replayed it (they
+    # carry the signed cookie set along with their write, or the token of a
+    # subject whose write was notified, whichever dyno served it), so that
+    # they read their own writes, and those of the cached endpoints, whose
+    # versions are the primary's
+    @app.before_request
+    def route_reads():
+        replicas = get_replicas(app)
+        if replicas and request.method in ('GET', 'HEAD') \
+                and request.endpoint not in response_cache.endpoints \
+                and not wrote_recently():
+            g.replica = random.choice(replicas)
+        else:
+            g.replica = None
+
+    @app.after_request
+    def pin_writer(response):
+        if get_replicas(app) and request.method not in ('GET', 'HEAD',
+                                                     'OPTIONS'):
+            response.set_cookie(
+                REPLICA_COOKIE, primary_signer().sign(b'primary').decode(),
+                max_age=math.ceil(app.config['REPLICA_STICKY_SECONDS']),
+                httponly=True, samesite='Lax')
+        return response
+
+    # responses of the read endpoints, with the tables each one reads
+    response_cache = ResponseCache(table_versions, app.config['RELEASE'],
+                                   maxsize=app.config['RESPONSE_CACHE_SIZE'],
+                                   ttl=app.config['RESPONSE_CACHE_TTL'])
+    MOVIE_TABLES = ('movies', 'genres', 'movie_genre', 'interpretations',
+                    'actors')
+    GENRE_TABLES = ('genres', 'movie_genre', 'movies')
+    ACTOR_TABLES = ('actors', 'interpretations', 'movies')
+
 # ROUTES ---------------------------------------------------------------
 
     @app.route('/')
@@ -30,16 +106,34 @@ def create_app(production=False):
     def loggedin():
         return '<h1>Please copy the JWT</h1>'
 
+    @app.route('/metrics')
+    @requires_auth(permission='get:metrics')
+    def metrics(payload):
+        ''' get the counters of the in-process caches of this worker, which
+        tell about the state of Auth0 as well: not for the public '''
+        return jsonify({
+            'success': True,
+            'token_cache': token_cache.stats(),
+            'response_cache': response_cache.stats(),
+            'table_versions': listener.stats(),
+            'compression': compression.stats(),
+            'jwks': jwks_store.stats(),
+            'jwks_refresher': jwks_refresher.stats(),
+        })
+
     # MOVIES -----------------------------------------------------------
 
     @app.route('/movies/<int:movie_id>')
     @requires_auth(permission='get:movies')
+    @response_cache.cached(*MOVIE_TABLES)
     def movie(payload, movie_id):
+        fields = get_fields(Movie)
         try:
-            movie = Movie.query.get(movie_id)
+            query = Movie.query.options(*Movie.format_options(fields))
+            movie = query.get(movie_id)
             return jsonify({
                 'success': True,
-                'movie': movie.format(),
+                'movie': movie.format(fields),
             })
         except AttributeError:  # happens when movie is None
             abort(404)
@@ -48,13 +142,30 @@ def create_app(production=False):
 
     @app.route('/movies')
     @requires_auth(permission='get:movies')
+    @response_cache.cached(*MOVIE_TABLES)
     def movies(payload):
+        fields = get_fields(Movie)
+        sort = request.args.get('sort', 'id')
+        if sort not in ('id', 'release_date'):
+            abort(400)
+        sort = Movie.release_date if sort == 'release_date' else None
+        # the sort key makes the next cursor, even if not returned
+        loaded = fields if sort is None or fields is None \
+            else fields | {'release_date'}
+        query = Movie.query.options(*Movie.format_options(loaded))
+        query = filter_movies(query)
+        if sort is not None:
+            query = query.filter(sort.isnot(None))
+        if request.args.get('stream') == 'true':
+            return stream_list('movie', query, Movie, fields, sort)
+        limit, after = get_page_args(sort)
         try:
-            movies = Movie.query.all()
-            movies = [movie.format() for movie in movies]
+            movies, next_cursor = paginate(query, Movie, limit, after, sort)
+            movies = [movie.format(fields) for movie in movies]
             return jsonify({
                 'success': True,
-                'movie': movies
+                'movie': movies,
+                'next': next_cursor,
             })
         except AttributeError:
             abort(404)
@@ -82,6 +193,24 @@ def create_app(production=False):
             'added': new_movie.id
         })
 
+    @app.route('/movies/bulk', methods=['POST'])
+    @requires_auth(permission='post:movies')
+    def add_movies(payload):
+        ''' add many movies at once, from a JSON array or NDJSON body '''
+        return bulk_create(Movie)
+
+    @app.route('/movies/bulk', methods=['PATCH'])
+    @requires_auth(permission='patch:movies')
+    def update_movies(payload):
+        ''' update many movies at once, from a JSON array or NDJSON body '''
+        return bulk_update(Movie)
+
+    @app.route('/movies/bulk', methods=['DELETE'])
+    @requires_auth(permission='delete:movies')
+    def delete_movies(payload):
+        ''' delete many movies at once, from a JSON array of ids '''
+        return bulk_delete(Movie)
+
     @app.route('/movies/update/<int:movie_id>', methods=['PATCH'])
     @requires_auth(permission='patch:movies')
     def update_movie(payload, movie_id):
@@ -126,12 +255,15 @@ def create_app(production=False):
 
     @app.route('/genres/<int:genre_id>')
     @requires_auth(permission='get:movies')
+    @response_cache.cached(*GENRE_TABLES)
     def genre(payload, genre_id):
+        fields = get_fields(Genre)
         try:
-            genre = Genre.query.get(genre_id)
+            query = Genre.query.options(*Genre.format_options(fields))
+            genre = query.get(genre_id)
             return jsonify({
                 'success': True,
-                'genre': genre.format(),
+                'genre': genre.format(fields),
             })
         except AttributeError:  # happens when genre is None
             abort(404)
@@ -140,13 +272,20 @@ def create_app(production=False):
 
     @app.route('/genres')
     @requires_auth(permission='get:movies')
+    @response_cache.cached(*GENRE_TABLES)
     def genres(payload):
+        fields = get_fields(Genre)
+        query = Genre.query.options(*Genre.format_options(fields))
+        if request.args.get('stream') == 'true':
+            return stream_list('genre', query, Genre, fields)
+        limit, after = get_page_args()
         try:
-            genres = Genre.query.all()
-            genres = [genre.format() for genre in genres]
+            genres, next_cursor = paginate(query, Genre, limit, after)
+            genres = [genre.format(fields) for genre in genres]
             return jsonify({
                 'success': True,
-                'genre': genres
+                'genre': genres,
+                'next': next_cursor,
             })
         except AttributeError:
             abort(404)
@@ -157,13 +296,16 @@ def create_app(production=False):
 
     @app.route('/actors/<int:actor_id>')
     @requires_auth(permission='get:actors')
+    @response_cache.cached(*ACTOR_TABLES)
     def actor(payload, actor_id):
         ''' get the actors full list '''
+        fields = get_fields(Actor)
         try:
-            actor = Actor.query.get(actor_id)
+            query = Actor.query.options(*Actor.format_options(fields))
+            actor = query.get(actor_id)
             return jsonify({
                 'success': True,
-                'actor': actor.format(),
+                'actor': actor.format(fields),
             })
         except AttributeError:  # happens when actor is None
             abort(404)
@@ -172,13 +314,20 @@ def create_app(production=False):
 
     @app.route('/actors')
     @requires_auth(permission='get:actors')
+    @response_cache.cached(*ACTOR_TABLES)
     def actors(payload):
+        fields = get_fields(Actor)
+        query = Actor.query.options(*Actor.format_options(fields))
+        if request.args.get('stream') == 'true':
+            return stream_list('actor', query, Actor, fields)
+        limit, after = get_page_args()
         try:
-            actors = Actor.query.all()
-            actors = [actor.format() for actor in actors]
+            actors, next_cursor = paginate(query, Actor, limit, after)
+            actors = [actor.format(fields) for actor in actors]
             return jsonify({
                 'success': True,
-                'actor': actors
+                'actor': actors,
+                'next': next_cursor,
             })
         except AttributeError:
             abort(404)
@@ -206,6 +355,24 @@ def create_app(production=False):
             'added': new_actor.id
         })
 
+    @app.route('/actors/bulk', methods=['POST'])
+    @requires_auth(permission='post:actors')
+    def add_actors(payload):
+        ''' add many actors at once, from a JSON array or NDJSON body '''
+        return bulk_create(Actor)
+
+    @app.route('/actors/bulk', methods=['PATCH'])
+    @requires_auth(permission='patch:actors')
+    def update_actors(payload):
+        ''' update many actors at once, from a JSON array or NDJSON body '''
+        return bulk_update(Actor)
+
+    @app.route('/actors/bulk', methods=['DELETE'])
+    @requires_auth(permission='delete:actors')
+    def delete_actors(payload):
+        ''' delete many actors at once, from a JSON array of ids '''
+        return bulk_delete(Actor)
+
     @app.route('/actors/update/<int:actor_id>', methods=['PATCH'])
     @requires_auth(permission='patch:actors')
     def update_actor(payload, actor_id):
@@ -247,6 +414,46 @@ def create_app(production=False):
             'deleted': actor.id
         })
 
+    # SEARCH -----------------------------------------------------------
+
+    @app.route('/search')
+    @requires_auth(permission='get:movies')
+    def search(payload):
+        ''' full-text search over movie titles, actor names and characters,
+        the latter two requiring the get:actors permission as well '''
+        q = request.args.get('q', '').strip()
+        if not q:
+            abort(400)
+        limit = get_page_size()
+        after = get_search_cursor()
+        types = ['movie']
+        if has_permission('get:actors'):
+            types += ['actor', 'interpretation']
+        try:
+            results, next_cursor = full_text_search(q, types, limit, after)
+            if next_cursor is not None:
+                next_cursor = ','.join(repr(x) if isinstance(x, float)
+                                       else str(x) for x in next_cursor)
+            return jsonify({
+                'success': True,
+                'results': results,
+                'next': next_cursor,
+            })
+        except Exception:
+            abort(422)
+
+    @app.route('/movies/lookup')
+    @requires_auth(permission='get:movies')
+    def lookup_movies(payload):
+        ''' typo-tolerant lookup of the movies by title '''
+        return lookup('movie')
+
+    @app.route('/actors/lookup')
+    @requires_auth(permission='get:actors')
+    def lookup_actors(payload):
+        ''' typo-tolerant lookup of the actors by name and surname '''
+        return lookup('actor')
+
     # ERROR HANDLERS ---------------------------------------------------
     @app.errorhandler(400)
     def bad_request(error):
@@ -289,12 +496,258 @@ def create_app(production=False):
         })
 
     # HELPER FUNCTIONS -------------------------------------------------
+    def primary_signer():
+        ''' Signer of the cookie sending the reads of a client which just
+        wrote to the primary, valid with the SECRET_KEY of any dyno '''
+        return TimestampSigner(app.secret_key, salt=REPLICA_COOKIE)
+
+    def wrote_recently():
+        ''' Tell whether the client wrote less than REPLICA_STICKY_SECONDS
+        ago, according to its cookie, or to the writes of the subject of its
+        token notified by the workers of every dyno '''
+        sticky = app.config['REPLICA_STICKY_SECONDS']
+        cookie = request.cookies.get(REPLICA_COOKIE)
+        if cookie is not None:
+            try:
+                primary_signer().unsign(cookie, max_age=sticky)
+                return True
+            except BadSignature:  # expired included
+                pass
+        subject = token_subject()
+        if subject is None:
+            return False
+        return recent_writers.get(subject, 0) > time.time() - sticky
+
     def capitalize_all(words):
         ''' Capitalize a string made of multiple words '''
         words = words.split(' ')
         words = ' '.join([x.capitalize() for x in words])
         return words
 
+    def get_fields(model):
+        ''' Get the format() keys requested by the "fields" and "include"
+        arguments, None if neither is given (all the keys). Without "fields"
+        only the plain columns are returned, along with the embedded lists
+        requested by "include". '''
+        fields = request.args.get('fields')
+        include = request.args.get('include')
+        if fields is None and include is None:
+            return None
+        fields = set(fields.split(',')) if fields else set(model.COLUMNS)
+        if include:
+            fields |= set(include.split(','))
+        if not fields <= set(model.COLUMNS + model.EMBEDDED):
+            abort(400)
+        return fields
+
+    def filter_movies(query):
+        ''' Filter the movies query by the "genre" name and the
+        "released_after" (included) and "released_before" (excluded) ISO
+        dates arguments. The genre is matched with an EXISTS subquery, so
+        the movies are neither repeated nor loaded with their genres. '''
+        genre = request.args.get('genre')
+        try:
+            after = request.args.get('released_after')
+            after = after and datetime.fromisoformat(after)
+            before = request.args.get('released_before')
+            before = before and datetime.fromisoformat(before)
+        except ValueError:
+            abort(400)
+        if genre:
+            query = query.filter(Movie.genre.any(Genre.name == genre))
+        if after:
+            query = query.filter(Movie.release_date >= after)
+        if before:
+            query = query.filter(Movie.release_date < before)
+        return query
+
+    def get_page_size():
+        ''' Get the page size from the "limit" argument, capped by the
+        MAX_PAGE_SIZE setting '''
+        try:
+            limit = int(request.args.get('limit',
+                                         app.config['DEFAULT_PAGE_SIZE']))
+        except ValueError:
+            abort(400)
+        if limit < 1:
+            abort(400)
+        return min(limit, app.config['MAX_PAGE_SIZE'])
+
+    def get_page_args(sort=None):
+        ''' Get the page size and cursor from the request arguments. The
+        cursor is an id, or a "<release date>,<id>" pair when sorting by the
+        sort column (None on the first page). '''
+        limit = get_page_size()
+        try:
+            if sort is None:
+                after = int(request.args.get('after', 0))
+            else:
+                after = request.args.get('after')
+                if after is not None:
+                    value, id_ = after.split(',')
+                    after = (datetime.fromisoformat(value), int(id_))
+        except ValueError:
+            abort(400)
+        return limit, after
+
+    def get_search_cursor():
+        ''' Get the "<rank>,<type>,<id>" cursor of the search results from
+        the "after" argument (None on the first page) '''
+        after = request.args.get('after')
+        if after is None:
+            return None
+        try:
+            rank, type_, id_ = after.split(',')
+            after = (float(rank), type_, int(id_))
+        except ValueError:
+            abort(400)
+        if not math.isfinite(after[0]) or type_ not in FULL_TEXT_MATCHES:
+            abort(400)
+        return after
+
+    def paginate(query, model, limit, after, sort=None):
+        ''' Keyset pagination: return the first limit rows whose primary key
+        is greater than after, along with the cursor of the next page (None
+        on the last page). Unlike OFFSET, the index seek makes deep pages
+        as cheap as the first one. With a sort column, the rows are ordered
+        by (sort, primary key) and after is such a pair. '''
+        if sort is None:
+            rows = (query.filter(model.id > after)
+                         .order_by(model.id)
+                         .limit(limit + 1)
+                         .all())
+            if len(rows) > limit:
+                return rows[:limit], rows[limit - 1].id
+            return rows, None
+
+        if after is not None:
+            query = query.filter(db.tuple_(sort, model.id) > db.tuple_(*after))
+        rows = query.order_by(sort, model.id).limit(limit + 1).all()
+        if len(rows) > limit:
+            last = rows[limit - 1]
+            value = getattr(last, sort.key)
+            return rows[:limit], f'{value.isoformat()},{last.id}'
+        return rows, None
+
+    def stream_list(key, query, model, fields=None, sort=None):
+        ''' Stream the whole list of the query results as JSON, one row at a
+        time: the rows are fetched from a server-side cursor
+        STREAM_BATCH_SIZE at a time and serialized as they come, so memory
+        use does not grow with the list size.
+
+        The status is sent before the rows are read, so the success key
+        closes the body instead: an error while streaming is logged and
+        ends the body with "success": false and "error": 500, for clients
+        to tell a truncated list from a complete one. '''
+        order = (model.id,) if sort is None else (sort, model.id)
+
+        def generate():
+            yield dumps({key: []})[:-2]
+            try:
+                rows = query.order_by(*order) \
+                            .yield_per(app.config['STREAM_BATCH_SIZE'])
+                for i, row in enumerate(rows):
+                    yield (b',' if i else b'') + dumps(row.format(fields))
+            except Exception:
+                app.logger.exception('Error while streaming the %s list', key)
+                yield b'],' + dumps({'success': False, 'error': 500})[1:]
+                return
+            yield b'],' + dumps({'success': True})[1:]
+        return Response(stream_with_context(generate()),
+                        mimetype='application/json')
+
+    def get_bulk_items():
+        ''' Get the items of the JSON array or NDJSON body of a bulk request,
+        at most BULK_MAX_ROWS of them '''
+        try:
+            items = parse_items(request.get_data(), request.mimetype)
+        except ValueError:
+            abort(400)
+        if len(items) > app.config['BULK_MAX_ROWS']:
+            abort(400)
+        return items
+
+    def bulk_create(model):
+        ''' Insert the valid rows of the bulk request in a single
+        transaction. Respond with the new ids in the body order (null for
+        the invalid rows), and the errors of the invalid rows. '''
+        items = get_bulk_items()
+        try:
+            added, errors = create_rows(model, items,
+                                        app.config['BULK_CHUNK_SIZE'])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            abort(422)
+
+        return jsonify({
+            'success': True,
+            'added': added,
+            'errors': errors,
+        })
+
+    def bulk_update(model):
+        ''' Apply the valid changes of the bulk request (id and changed
+        columns) with a single UPDATE statement. Respond with the updated
+        ids, and the errors of the invalid or missing rows. '''
+        items = get_bulk_items()
+        try:
+            updated, errors = patch_rows(model, items)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            abort(422)
+
+        return jsonify({
+            'success': True,
+            'updated': updated,
+            'errors': errors,
+        })
+
+    def bulk_delete(model):
+        ''' Delete the rows of the ids of the bulk request, along with their
+        interpretations, in a single transaction. Respond with the deleted
+        ids, and the ones which were not found. '''
+        ids = get_bulk_items()
+        if not all(is_id(x) for x in ids):
+            abort(400)
+        ids = list(dict.fromkeys(ids))
+        try:
+            deleted = delete_rows(model, ids) if ids else []
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            abort(422)
+
+        deleted = set(deleted)
+        return jsonify({
+            'success': True,
+            'deleted': [x for x in ids if x in deleted],
+            'not_found': [x for x in ids if x not in deleted],
+        })
+
+    def lookup(type_):
+        ''' Respond with the type_ entities whose name is the most similar to
+        the q argument: the top "limit" ones (capped by MAX_LOOKUP_SIZE),
+        scoring at least "threshold" '''
+        q = request.args.get('q', '').strip()
+        try:
+            limit = int(request.args.get('limit', app.config['LOOKUP_SIZE']))
+            threshold = float(request.args.get(
+                'threshold', app.config['LOOKUP_THRESHOLD']))
+        except ValueError:
+            abort(400)
+        if not q or limit < 1 or not 0 <= threshold <= 1:
+            abort(400)
+        limit = min(limit, app.config['MAX_LOOKUP_SIZE'])
+        try:
+            return jsonify({
+                'success': True,
+                'results': fuzzy_lookup(q, type_, limit, threshold),
+            })
+        except Exception:
+            abort(422)
+
     return app
 
 # how to run:
@@ -1,14 +1,66 @@
 import os
-from flask import request, abort
+import hashlib
+from flask import request, abort, g
 from functools import wraps
-import json
-from urllib.request import urlopen
 from jose import jwt
+from jose.utils import base64url_decode
+
+from app.cache import LRUCache
+from app.jwks import (JWKSFetcher, JWKSFileFetcher, JWKSRefresher, JWKSStore,
+                      get_key_backend)
 
 AUTH0_DOMAIN = os.getenv('AUTH0_DOMAIN')
 ALGORITHMS = [os.getenv('AUTH0_ALGORITHMS')]
 API_AUDIENCE = os.getenv('AUTH0_API_AUDIENCE')
 
+# the key set is read from AUTH0_JWKS_FILE, if set, or downloaded from
+# AUTH0_JWKS_URL, which can point to a local stand-in for Auth0
+JWKS_FILE = os.getenv('AUTH0_JWKS_FILE')
+JWKS_URL = os.getenv('AUTH0_JWKS_URL',
+                     f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+
+if JWKS_FILE:
+    jwks_fetcher = JWKSFileFetcher(JWKS_FILE)
+else:
+    jwks_fetcher = JWKSFetcher(
+        JWKS_URL,
+        connect_timeout=float(os.getenv('AUTH0_JWKS_CONNECT_TIMEOUT', 2)),
+        read_timeout=float(os.getenv('AUTH0_JWKS_READ_TIMEOUT', 3)),
+        failure_threshold=int(os.getenv('AUTH0_JWKS_FAILURE_THRESHOLD', 3)),
+        reset_timeout=int(os.getenv('AUTH0_JWKS_RESET_TIMEOUT', 30)),
+    )
+
+# the key set is downloaded once and shared by all the requests of a worker
+jwks_store = JWKSStore(
+    JWKS_URL,
+    default_ttl=int(os.getenv('AUTH0_JWKS_TTL', 600)),
+    min_ttl=int(os.getenv('AUTH0_JWKS_MIN_TTL', 60)),
+    max_ttl=int(os.getenv('AUTH0_JWKS_MAX_TTL', 86400)),
+    refetch_interval=int(os.getenv('AUTH0_JWKS_REFETCH_INTERVAL', 30)),
+    key_class=get_key_backend(os.getenv('AUTH0_RSA_BACKEND', 'auto')),
+    fetcher=jwks_fetcher,
+)
+
+# refreshes the key set ahead of its expiration, started by create_app()
+jwks_refresher = JWKSRefresher(
+    jwks_store,
+    lead=int(os.getenv('AUTH0_JWKS_REFRESH_LEAD', 10)),
+    retry=int(os.getenv('AUTH0_JWKS_REFRESH_RETRY', 5)),
+)
+
+# known permissions, each one mapped to a bit of the permissions bitmask
+PERMISSIONS = {permission: 1 << i for i, permission in enumerate((
+    'get:movies', 'post:movies', 'patch:movies', 'delete:movies',
+    'get:actors', 'post:actors', 'patch:actors', 'delete:actors',
+    'get:metrics',
+))}
+
+# decoded payloads of the already verified tokens, along with their
+# permissions bitmask, keyed by token digest and kept until the token
+# expires; flushed whenever the signing keys rotate
+token_cache = LRUCache(maxsize=int(os.getenv('AUTH0_TOKEN_CACHE_SIZE', 1024)))
+jwks_store.listeners.append(token_cache.clear)
+
 
 class AuthError(Exception):
     ''' Raised whenever the @requires_auth decorator fails '''
@@ -49,14 +101,35 @@ def get_token_auth_header():
     return token
 
 
+def verify_decode_jwt_cached(token):
+    ''' Return the decoded payload of a token and its permissions bitmask,
+    verifying the token only if it has not been verified already '''
+    digest = hashlib.sha256(token.encode()).digest()
+    entry = token_cache.get(digest)
+    if entry is None:
+        payload = verify_decode_jwt(token)
+        entry = (payload, permissions_mask(payload))
+        if 'exp' in payload:
+            token_cache.set(digest, entry, expires_at=payload['exp'])
+    else:
+        jwks_store.keys()  # let the key set get revalidated once expired
+    return entry
+
+
+def token_subject():
+    ''' Return the subject of the token of the request, None if it has none
+    or is not valid (then rejected by @requires_auth) '''
+    try:
+        payload, _ = verify_decode_jwt_cached(get_token_auth_header())
+    except Exception:  # left for @requires_auth to report
+        return None
+    return payload.get('sub')
+
+
 def verify_decode_jwt(token):
     ''' Get the token and the public key, return the decoded payload '''
 
     unverified_header = jwt.get_unverified_header(token)
-    # open the url and store a byte string
-    json_url = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(json_url.read())  # convert to a json
-    rsa_key = dict()
 
     if 'kid' not in unverified_header:
         raise AuthError({
@@ -64,24 +137,17 @@ def verify_decode_jwt(token):
             'description': 'Invalid Authorization header. Must contain a KID'
         }, 401)
 
-    # get the public key
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e'],
-            }
-            break
+    # get the already constructed public key from the cached key set
+    rsa_key = jwks_store.get_key(unverified_header['kid'])
     if rsa_key:  # verify the signature
         try:
-
+            verify_signature(token, unverified_header, rsa_key)
+            # the signature is verified, only validate the claims
             payload = jwt.decode(
                 token,
                 rsa_key,
                 algorithms=ALGORITHMS,
+                options={'verify_signature': False},
                 audience=API_AUDIENCE,
                 issuer=f'https://{AUTH0_DOMAIN}/'
             )
@@ -109,14 +175,35 @@ def verify_decode_jwt(token):
             }, 400)
 
 
-def check_permissions(permission, payload):
-    ''' Check if the request comes with the suitable Role permissions '''
+def verify_signature(token, header, key):
+    ''' Verify the token signature with a python-jose key object '''
+    if header.get('alg') not in ALGORITHMS:
+        raise jwt.JWTError('The specified alg value is not allowed')
+    signing_input, _, signature = token.rpartition('.')
+    if not key.verify(signing_input.encode(),
+                      base64url_decode(signature.encode())):
+        raise jwt.JWTError('Signature verification failed.')
+
+
+def permissions_mask(payload):
+    ''' Return the bitmask of the known permissions granted by a payload,
+    None if the payload does not hold any permissions claim '''
     if 'permissions' not in payload:
+        return None
+    mask = 0
+    for permission in payload['permissions']:
+        mask |= PERMISSIONS.get(permission, 0)
+    return mask
+
+
+def check_permission_mask(required, granted):
+    ''' Check the required permission bit against the granted bitmask '''
+    if granted is None:
         raise AuthError({
             'code': 'invalid_token',
             'description': 'Unable to find permissions.'
             }, 400)
-    if permission not in payload['permissions']:
+    if not granted & required:
         raise AuthError({
             'code': 'forbidden',
             'description': 'User does not have required permissions.'
@@ -124,21 +211,41 @@ def check_permissions(permission, payload):
     return True
 
 
+def check_permissions(permission, payload):
+    ''' Check if the request comes with the suitable Role permissions '''
+    return check_permission_mask(PERMISSIONS.get(permission, 0),
+                                 permissions_mask(payload))
+
+
+def has_permission(permission):
+    ''' Tell whether the token of the current request, verified by
+    @requires_auth, also grants permission '''
+    return bool(g.get('permissions') & PERMISSIONS[permission])
+
+
 def requires_auth(permission=''):
     ''' This is used as a DECORATOR for the endpoints.
     Get the token, decode the JWT, validate claims, check the requested
     permission.
     Return the decorator which passes the decoded payload to the decorated
-    function. '''
+    function.
+    The permission must be a known one: it is resolved to its bit once, when
+    the endpoint is defined, rather than on every request. '''
+    if permission not in PERMISSIONS:
+        raise ValueError(f'Unknown permission: "{permission}"')
+    required = PERMISSIONS[permission]
+
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
             token = get_token_auth_header()
             try:
-                payload = verify_decode_jwt(token)
+                payload, granted = verify_decode_jwt_cached(token)
             except AuthError as e:
                 abort(401, e.error)
-            check_permissions(permission, payload)
+            check_permission_mask(required, granted)
+            g.permissions = granted
+            g.subject = payload.get('sub')
             return f(payload, *args, **kwargs)
         return wrapper
     return requires_auth_decorator
@@ -0,0 +1,249 @@
+from datetime import datetime
+
+from flask import json
+
+from app.models import db, Movie, Actor, Interpretation, movie_genre
+
+
+def parse_items(data, mimetype):
+    ''' Return the items of a JSON array, or NDJSON (one JSON object per
+    line) body. The NDJSON lines which are not valid JSON are returned as
+    None, to be reported along with the other invalid rows. Raise
+    ValueError when the body itself is invalid. '''
+    text = data.decode('utf-8')
+    if mimetype in ('application/x-ndjson', 'application/jsonl'):
+        items = []
+        for line in text.splitlines():
+            if line.strip():
+                try:
+                    items.append(json.loads(line))
+                except ValueError:
+                    items.append(None)
+        return items
+    items = json.loads(text)
+    if not isinstance(items, list):
+        raise ValueError('not a JSON array')
+    return items
+
+
+def capitalize_all(words):
+    ''' Capitalize a string made of multiple words, as /movies/add does '''
+    return ' '.join([x.capitalize() for x in words.split(' ')])
+
+
+def parse_text(max_length, transform=None):
+    ''' Return a parser of non-empty strings of at most max_length
+    characters, optionally transformed '''
+    def parse(value):
+        if not isinstance(value, str) or not value.strip():
+            raise ValueError('must be a non-empty string')
+        value = value.strip()
+        if len(value) > max_length:
+            raise ValueError(f'must be at most {max_length} characters')
+        return transform(value) if transform else value
+    return parse
+
+
+def parse_date(value):
+    ''' Parse an ISO 8601 date or date and time '''
+    if not isinstance(value, str):
+        raise ValueError('must be an ISO 8601 date')
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError('must be an ISO 8601 date')
+
+
+# column: (required, parser) of the rows created or updated in bulk, with
+# the same normalization as the single row /movies/add and /actors/add
+# endpoints
+BULK_COLUMNS = {
+    Movie: {
+        'title': (True, parse_text(120, capitalize_all)),
+        'release_date': (False, parse_date),
+    },
+    Actor: {
+        'name': (True, parse_text(120, str.capitalize)),
+        'surname': (True, parse_text(120, str.capitalize)),
+        'dob': (False, parse_date),
+        'gender': (False, parse_text(10)),
+    },
+}
+
+
+def validate_item(model, item, update=False):
+    ''' Return the column values of the item (every column being set, the
+    missing optional ones to None), and its errors by key. The items of an
+    update carry the id of their row, and None leaves a column unchanged. '''
+    columns = BULK_COLUMNS[model]
+    if not isinstance(item, dict):
+        return None, {'row': 'must be a JSON object'}
+    values, errors = dict(), dict()
+    for key in item.keys() - columns.keys() - ({'id'} if update else set()):
+        errors[key] = 'unknown field'
+    if update:
+        values['id'] = item.get('id')
+        if not is_id(values['id']):
+            errors['id'] = 'must be an integer'
+        if all(item.get(x) is None for x in columns):
+            errors['row'] = 'nothing to update'
+    for key, (required, parse) in columns.items():
+        value = item.get(key)
+        if value is None:
+            if required and not update:
+                errors[key] = 'required'
+            values[key] = None
+            continue
+        try:
+            values[key] = parse(value)
+        except ValueError as e:
+            errors[key] = str(e)
+    return (None if errors else values), errors
+
+
+def is_id(value):
+    ''' Tell whether value is an integer (JSON true and false are not) '''
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def supports_returning():
+    ''' Tell whether the database supports the RETURNING clause, SQLite (the
+    tests) does not with SQLAlchemy 1.3 '''
+    return db.session.get_bind().dialect.name == 'postgresql'
+
+
+def fill_defaults(table, row):
+    ''' Return the row with the default of its columns in place of None,
+    as the ORM does for the missing values. The multi-row INSERT statements
+    bind every column of every row, None included, so that they would write
+    NULL otherwise. '''
+    row = dict(row)
+    for key, value in row.items():
+        default = table.c[key].default
+        if value is None and default is not None:
+            row[key] = default.arg(None) if default.is_callable \
+                else default.arg
+    return row
+
+
+def insert_rows(model, rows, chunk_size):
+    ''' Insert the rows (column values) within the current transaction with
+    multi-row INSERT statements of chunk_size rows, return their ids in
+    order '''
+    if not rows:
+        return []
+    # the same values whichever way the rows are inserted
+    rows = [fill_defaults(model.__table__, x) for x in rows]
+    if not supports_returning():  # row by row
+        objects = [model(**row) for row in rows]
+        db.session.add_all(objects)
+        db.session.flush()
+        return [x.id for x in objects]
+
+    table = model.__table__
+    ids = []
+    for i in range(0, len(rows), chunk_size):
+        statement = table.insert() \
+                         .values(rows[i:i + chunk_size]) \
+                         .returning(table.c.id)
+        # the ids are drawn from the sequence in the VALUES order, sorting
+        # them does not rely on the order of the RETURNING rows
+        ids += sorted(x.id for x in db.session.execute(statement))
+    return ids
+
+
+def create_rows(model, items, chunk_size):
+    ''' Insert the valid items within the current transaction, return the
+    new ids in the items order (None for the invalid ones), and the list of
+    the errors of the invalid ones, by index '''
+    rows, errors = [], []
+    for index, item in enumerate(items):
+        values, item_errors = validate_item(model, item)
+        rows.append(values)
+        if item_errors:
+            errors.append({'index': index, 'errors': item_errors})
+    ids = iter(insert_rows(model, [x for x in rows if x is not None],
+                           chunk_size))
+    return [None if x is None else next(ids) for x in rows], errors
+
+
+def update_rows(model, rows):
+    ''' Apply the rows (id and column values, None leaving a column
+    unchanged) within the current transaction with a single UPDATE
+    statement, return the ids of the updated rows '''
+    if not rows:
+        return []
+    table = model.__table__
+    columns = list(BULK_COLUMNS[model])
+    if not supports_returning():  # row by row
+        updated = []
+        for row in rows:
+            values = {x: row[x] for x in columns if row[x] is not None}
+            result = db.session.execute(
+                table.update().where(table.c.id == row['id']).values(values))
+            if result.rowcount:
+                updated.append(row['id'])
+        return updated
+
+    # the rows are joined as arrays, one per column, unnested side by side
+    dialect = db.session.get_bind().dialect
+    keys = ['id'] + columns
+    arrays = ', '.join(f'CAST(:{x} AS {table.c[x].type.compile(dialect)}[])'
+                       for x in keys)
+    changes = ', '.join(f'{x} = coalesce(changes.{x}, {table.name}.{x})'
+                        for x in columns)
+    statement = db.text(
+        f'UPDATE {table.name} SET {changes} '
+        f'FROM unnest({arrays}) AS changes({", ".join(keys)}) '
+        f'WHERE {table.name}.id = changes.id '
+        f'RETURNING {table.name}.id')
+    result = db.session.execute(statement, {
+        x: [row[x] for row in rows] for x in keys})
+    return [x.id for x in result]
+
+
+def patch_rows(model, items):
+    ''' Update the rows of the valid items within the current transaction,
+    return the ids of the updated rows in the items order, and the list of
+    the errors of the invalid items or missing rows, by index '''
+    rows, errors, seen = [], [], set()
+    for index, item in enumerate(items):
+        values, item_errors = validate_item(model, item, update=True)
+        if values is not None and values['id'] in seen:
+            values, item_errors = None, {'id': 'duplicate id'}
+        if values is not None:
+            seen.add(values['id'])
+        rows.append(values)
+        if item_errors:
+            errors.append({'index': index, 'errors': item_errors})
+    updated = set(update_rows(model, [x for x in rows if x is not None]))
+    for index, row in enumerate(rows):
+        if row is not None and row['id'] not in updated:
+            errors.append({'index': index, 'errors': {'id': 'not found'}})
+    errors.sort(key=lambda x: x['index'])
+    return [x['id'] for x in rows if x is not None and x['id'] in updated], \
+        errors
+
+
+def delete_rows(model, ids):
+    ''' Delete the rows of ids within the current transaction, along with
+    their interpretations and (for movies) their genre associations, return
+    the ids of the deleted rows '''
+    table = model.__table__
+    interpretations = Interpretation.__table__
+    key = 'movie_id' if model is Movie else 'actor_id'
+    db.session.execute(interpretations.delete()
+                                      .where(interpretations.c[key].in_(ids)))
+    if model is Movie:
+        db.session.execute(movie_genre.delete()
+                                      .where(movie_genre.c.movie_id.in_(ids)))
+
+    statement = table.delete().where(table.c.id.in_(ids))
+    if supports_returning():
+        deleted = db.session.execute(statement.returning(table.c.id))
+        return [x.id for x in deleted]
+    deleted = db.session.execute(db.select([table.c.id])
+                                   .where(table.c.id.in_(ids)))
+    deleted = [x.id for x in deleted]
+    db.session.execute(statement)
+    return deleted
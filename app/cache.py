@@ -0,0 +1,153 @@
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app, request
+
+
+class LRUCache:
+    ''' Thread-safe, size bounded Least Recently Used cache.
+
+    Each entry expires at its own time (a unix timestamp), which defaults to
+    `ttl` seconds after insertion when the cache has a ttl. Hits and misses
+    are counted so that the cache efficiency can be monitored. '''
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        ''' Return the value stored under key, default if missing or
+        expired '''
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at is None or expires_at > time.time():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def set(self, key, value, expires_at=None):
+        ''' Store value under key, evicting the least recently used entry
+        if the cache is full '''
+        if expires_at is None and self.ttl is not None:
+            expires_at = time.time() + self.ttl
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        ''' Return the cache counters as a dictionary '''
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+    def __len__(self):
+        return len(self._data)
+
+
+class ResponseCache:
+    ''' Per-worker cache of the responses of the read endpoints, bounded in
+    size and time by a LRUCache, which also answers the conditional
+    requests.
+
+    The responses are keyed by path and arguments, and by the versions of
+    the tables they were read from: a write to any of these tables (be it
+    to a movie's cast, embedded in an actor's filmography) makes the cached
+    response unreachable, to be evicted as the least recently used.
+
+    The versions are held in memory, and moved by the database itself on
+    commit (see TableVersions in app/notifications.py): they are the same
+    for every worker of every dyno, and a hit runs no query at all. Along
+    with the epoch, identifying the release of the app, they make the
+    strong ETag of the responses, so that a request whose If-None-Match
+    holds the current one is answered with 304 Not Modified before the view
+    runs. While the versions are unknown, the responses are neither cached
+    nor tagged.
+
+    The versions follow the commits of the primary database, which the
+    views of the endpoints listed in `endpoints` must read from. '''
+
+    def __init__(self, versions, epoch, maxsize=256, ttl=60):
+        self.versions = versions
+        self.epoch = epoch
+        self.entries = LRUCache(maxsize=maxsize, ttl=ttl)
+        self.endpoints = set()
+        self.not_modified = 0
+
+    def etag(self, versions):
+        ''' Return the ETag of the responses read from tables of versions '''
+        return '-'.join([self.epoch] + [str(x) for x in versions])
+
+    def cached(self, *tables):
+        ''' Decorator caching the responses of a view reading tables, but
+        the streamed ones, and answering its conditional requests '''
+        def decorator(f):
+            self.endpoints.add(f.__name__)
+
+            @wraps(f)
+            def wrapper(*args, **kwargs):
+                # the versions are read first: a write committed while the
+                # view runs leaves its response behind, under the old ones
+                versions = self.versions.get(tables)
+                if versions is None:
+                    return f(*args, **kwargs)
+                etag = self.etag(versions)
+                if request.if_none_match.contains_weak(etag):
+                    self.not_modified += 1
+                    response = current_app.response_class(status=304)
+                    return self.validated(response, etag)
+                key = (request.path,
+                       tuple(sorted(request.args.items(multi=True))),
+                       versions)
+                entry = self.entries.get(key)
+                if entry is not None:
+                    body, mimetype = entry
+                    response = current_app.response_class(body,
+                                                          mimetype=mimetype)
+                    return self.validated(response, etag)
+                response = f(*args, **kwargs)
+                if not response.is_streamed:
+                    self.entries.set(key, (response.get_data(),
+                                           response.mimetype))
+                return self.validated(response, etag)
+            return wrapper
+        return decorator
+
+    def validated(self, response, etag):
+        ''' Set the validator of response: clients (and shared caches, which
+        must not store the responses to authenticated requests) are to
+        revalidate it with each request '''
+        response.set_etag(etag)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
+
+    def stats(self):
+        stats = self.entries.stats()
+        stats['not_modified'] = self.not_modified
+        return stats
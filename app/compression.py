@@ -0,0 +1,169 @@
+import zlib
+
+from flask import request
+
+from app.cache import LRUCache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def gzip_compressor(level):
+    ''' Return the (compress, sync, flush) functions of a gzip stream '''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    return (compressor.compress,
+            lambda: compressor.flush(zlib.Z_SYNC_FLUSH),
+            compressor.flush)
+
+
+def brotli_compressor(level):
+    ''' Return the (compress, sync, flush) functions of a brotli stream '''
+    compressor = brotli.Compressor(quality=level)
+    return compressor.process, compressor.flush, compressor.finish
+
+
+def zstd_compressor(level):
+    ''' Return the (compress, sync, flush) functions of a zstd stream '''
+    compressor = zstandard.ZstdCompressor(level=level).compressobj()
+    return (compressor.compress,
+            lambda: compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK),
+            compressor.flush)
+
+
+# content codings, from the most to the least preferred when the client
+# accepts several of them equally, left out when their module is missing
+CODINGS = dict()
+if brotli is not None:
+    CODINGS['br'] = brotli_compressor
+if zstandard is not None:
+    CODINGS['zstd'] = zstd_compressor
+CODINGS['gzip'] = gzip_compressor
+
+COMPRESSIBLE = ('application/json', 'text/')
+
+
+class Compression:
+    ''' Compression of the responses of an app, negotiated with the
+    Accept-Encoding header of the requests.
+
+    The responses smaller than COMPRESSION_MIN_SIZE bytes are left as is,
+    the others are compressed at the COMPRESSION_LEVELS level of their
+    coding. The streamed responses are compressed chunk by chunk as they
+    are sent, the compressor being flushed whenever COMPRESSION_FLUSH_SIZE
+    bytes went in since its last flush: it would hold the whole response
+    back otherwise. The compressed bodies of the responses with a strong ETag
+    (which only change along with it) are cached by URL and ETag, so that
+    they are only compressed once. '''
+
+    def __init__(self, app=None):
+        self.responses = 0
+        self.streams = 0
+        self.cache = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.min_size = app.config['COMPRESSION_MIN_SIZE']
+        self.levels = app.config['COMPRESSION_LEVELS']
+        self.flush_size = app.config['COMPRESSION_FLUSH_SIZE']
+        self.cache = LRUCache(maxsize=app.config['COMPRESSION_CACHE_SIZE'])
+        app.after_request(self.compress_response)
+
+    def compress_response(self, response):
+        ''' Compress the response with the coding preferred by the client,
+        if any and the response is worth it '''
+        if not self.compressible(response):
+            return response
+        response.vary.add('Accept-Encoding')
+        coding = request.accept_encodings.best_match(list(CODINGS))
+        if coding is None:
+            return response
+        if response.status_code == 304:
+            # the client holds the compressed response
+            self.weaken_etag(response)
+            return response
+
+        if response.is_streamed:
+            self.streams += 1
+            response.response = self.compress_stream(response.response,
+                                                     coding,
+                                                     response.charset)
+            response.headers.pop('Content-Length', None)
+        else:
+            body = response.get_data()
+            if len(body) < self.min_size:
+                return response
+            self.responses += 1
+            response.set_data(self.compress_body(body, coding, response))
+        response.headers['Content-Encoding'] = coding
+        self.weaken_etag(response)
+        return response
+
+    def compressible(self, response):
+        return (
+            (200 <= response.status_code < 300
+             or response.status_code == 304)
+            and response.status_code not in (204, 206)
+            and 'Content-Encoding' not in response.headers
+            and not response.direct_passthrough
+            and response.mimetype.startswith(COMPRESSIBLE)
+        )
+
+    def weaken_etag(self, response):
+        ''' The compressed responses only keep a weak ETag (equivalent, but
+        not byte for byte identical), which the If-None-Match weak
+        comparison still matches '''
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+
+    def compress_body(self, body, coding, response):
+        etag, weak = response.get_etag()
+        key = (request.full_path, etag, coding) if etag and not weak \
+            else None
+        if key is not None:
+            compressed = self.cache.get(key)
+            if compressed is not None:
+                return compressed
+        compress, _, flush = CODINGS[coding](self.levels[coding])
+        compressed = compress(body) + flush()
+        if key is not None:
+            self.cache.set(key, compressed)
+        return compressed
+
+    def compress_stream(self, chunks, coding, charset):
+        compress, sync, flush = CODINGS[coding](self.levels[coding])
+        pending = 0  # bytes compressed since the last flush
+        try:
+            for chunk in chunks:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode(charset)
+                data = compress(chunk)
+                pending += len(chunk)
+                if pending >= self.flush_size:
+                    data += sync()
+                    pending = 0
+                if data:
+                    yield data
+            yield flush()
+        finally:
+            # pops the request context kept by stream_with_context
+            close = getattr(chunks, 'close', None)
+            if close is not None:
+                close()
+
+    def stats(self):
+        ''' Return the compression counters as a dictionary '''
+        return {
+            'codings': list(CODINGS),
+            'responses': self.responses,
+            'streams': self.streams,
+            'cache': self.cache.stats(),
+        }
@@ -1,12 +1,104 @@
+import hashlib
 import os
 
 
+def engine_options():
+    ''' SQLAlchemy engine options of the workers' connection pool, from the
+    DB_* environment variables '''
+    connect_args = {
+        # seconds to wait for the server
+        'connect_timeout': int(os.getenv('DB_CONNECT_TIMEOUT', 5)),
+    }
+    statement_timeout = os.getenv('DB_STATEMENT_TIMEOUT')  # milliseconds
+    if statement_timeout:
+        connect_args['options'] = f'-c statement_timeout={statement_timeout}'
+    return {
+        # connections kept open, and opened on top of them under load
+        'pool_size': int(os.getenv('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', 10)),
+        # seconds to wait for a connection when they are all in use
+        'pool_timeout': int(os.getenv('DB_POOL_TIMEOUT', 30)),
+        # seconds after which a connection is replaced, -1 for never
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', 1800)),
+        # test the connections before using them, so that those closed by a
+        # failover or restart of the server are replaced transparently
+        'pool_pre_ping': os.getenv('DB_POOL_PRE_PING', 'true') == 'true',
+        'connect_args': connect_args,
+    }
+
+
+def release():
+    ''' Identifier of the running release: the Heroku release (see
+    runtime-dyno-metadata) or slug commit, else a digest of the app's
+    sources and requirements, the same on every dyno running them '''
+    for name in ('HEROKU_RELEASE_VERSION', 'HEROKU_SLUG_COMMIT',
+                 'SOURCE_VERSION'):
+        if os.getenv(name):
+            return os.getenv(name)[:12]
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    paths = [os.path.join('app', x)
+             for x in os.listdir(os.path.join(root, 'app'))
+             if x.endswith('.py')]
+    digest = hashlib.sha256()
+    for path in sorted(paths) + ['requirements.txt']:
+        digest.update(path.encode())
+        try:
+            with open(os.path.join(root, path), 'rb') as f:
+                digest.update(f.read())
+        except FileNotFoundError:
+            pass
+    return digest.hexdigest()[:8]
+
+
+def replica_binds():
+    ''' SQLAlchemy binds of the read replicas, from the comma separated
+    DATABASE_REPLICA_URLS environment variable '''
+    urls = os.getenv('DATABASE_REPLICA_URLS', '')
+    urls = [x.strip() for x in urls.split(',') if x.strip()]
+    return {f'replica{i}': url for i, url in enumerate(urls)}
+
+
 class Config:
     ''' Base config '''
 
-    SECRET_KEY = os.urandom(32)
+    # shared by the dynos, which check each other's signed cookies
+    SECRET_KEY = os.getenv('SECRET_KEY', os.urandom(32))
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     DEBUG = True
+    # the keys of the JSON responses are left in their natural order
+    JSON_SORT_KEYS = False
+    # prime the Auth0 JWKS at startup and refresh it in the background
+    JWKS_REFRESH = True
+    # number of rows returned by the list endpoints, see ?limit=
+    DEFAULT_PAGE_SIZE = 100
+    MAX_PAGE_SIZE = 1000
+    # rows fetched at a time by the streamed lists, see ?stream=true
+    STREAM_BATCH_SIZE = 500
+    # candidates returned by the fuzzy lookups, and their minimum score
+    # between 0 and 1, see /movies/lookup and /actors/lookup
+    LOOKUP_SIZE = 10
+    MAX_LOOKUP_SIZE = 100
+    LOOKUP_THRESHOLD = 0.4
+    # rows accepted by the bulk endpoints, and inserted per statement
+    BULK_MAX_ROWS = 50000
+    BULK_CHUNK_SIZE = 1000
+    # responses of the read endpoints cached by each worker, and for how
+    # many seconds; they are never served once a table they were read from
+    # was written to, see TableVersions
+    RESPONSE_CACHE_SIZE = 256
+    RESPONSE_CACHE_TTL = 60
+    # responses compressed when larger than COMPRESSION_MIN_SIZE bytes, at
+    # the level of the negotiated coding (br and zstd need the brotli and
+    # zstandard packages); the compressed bodies of the cached responses
+    # are cached as well, and the streamed ones are sent every
+    # COMPRESSION_FLUSH_SIZE uncompressed bytes
+    COMPRESSION_MIN_SIZE = 1024
+    COMPRESSION_LEVELS = {'br': 4, 'zstd': 3, 'gzip': 6}
+    COMPRESSION_FLUSH_SIZE = 16384
+    COMPRESSION_CACHE_SIZE = 128
+    # identifies the release in the ETags, whose responses change along with
+    # the code
+    RELEASE = release()
 
     username = 'postgres'
     password = 'postgres'
@@ -16,6 +108,12 @@ class Config:
 
     SQLALCHEMY_DATABASE_URI = \
         f"postgresql://{username}:{password}@{host}:{port}/{db_name}"
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options()
+    # the GET requests are served by the read replicas, but those of a
+    # client for REPLICA_STICKY_SECONDS after its write (which they may not
+    # have replayed yet), see create_app()
+    SQLALCHEMY_BINDS = replica_binds()
+    REPLICA_STICKY_SECONDS = float(os.getenv('DB_REPLICA_STICKY_SECONDS', 5))
 
 
 class Production(Config):
@@ -23,3 +121,15 @@ class Production(Config):
 
     DEBUG = False
     SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URL')
+    # the same on every dyno, see create_app()
+    SECRET_KEY = os.getenv('SECRET_KEY')
+
+
+class Testing(Config):
+    ''' Config for the hermetic tests, using an in-memory SQLite database '''
+
+    JWKS_REFRESH = False
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    # the in-memory database lives in its single connection
+    SQLALCHEMY_ENGINE_OPTIONS = {}
+    SQLALCHEMY_BINDS = {}
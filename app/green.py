@@ -0,0 +1,37 @@
+from gevent import monkey
+from gevent.socket import wait_read, wait_write
+from psycopg2 import OperationalError, extensions
+
+
+def wait_callback(connection):
+    ''' Wait for the queries of a psycopg2 connection by polling its socket
+    from the gevent hub, letting the other greenlets run meanwhile '''
+    while True:
+        state = connection.poll()
+        if state == extensions.POLL_OK:
+            return
+        if state == extensions.POLL_READ:
+            wait_read(connection.fileno())
+        elif state == extensions.POLL_WRITE:
+            wait_write(connection.fileno())
+        else:
+            raise OperationalError(f'Bad result from poll: {state}')
+
+
+def patch_psycopg():
+    ''' Make psycopg2 cooperative with gevent. libpq itself never yields,
+    so that monkey patching the sockets leaves it blocking the worker. '''
+    extensions.set_wait_callback(wait_callback)
+
+
+def patch_worker():
+    ''' Make a gevent worker forked from the preloaded app cooperative: the
+    standard library, psycopg2, and the locks the app recreated after the
+    fork, before the standard library was patched. The JWKS refresher
+    thread, restarted at the same time, stays a native thread. '''
+    from app.auth import jwks_store
+    monkey.patch_all()
+    jwks_store._after_fork()
+    if hasattr(jwks_store.fetcher, '_after_fork'):  # not JWKSFileFetcher
+        jwks_store.fetcher._after_fork()
+    patch_psycopg()
@@ -0,0 +1,411 @@
+import http.client
+import json
+import os
+import re
+import threading
+import time
+from importlib import import_module
+from urllib.parse import urlsplit
+
+
+MAX_AGE = re.compile(r'max-age=(\d+)')
+
+# python-jose RSA key classes, from the fastest to the slowest
+RSA_BACKENDS = {
+    'cryptography': ('jose.backends.cryptography_backend',
+                     'CryptographyRSAKey'),
+    'pycrypto': ('jose.backends.pycrypto_backend', 'RSAKey'),
+    'rsa': ('jose.backends.rsa_backend', 'RSAKey'),
+}
+
+
+def get_key_backend(name='auto'):
+    ''' Return the python-jose RSA key class of the given backend, or the
+    fastest one installed if name is "auto" '''
+    if name != 'auto':
+        module, key_class = RSA_BACKENDS[name]
+        return getattr(import_module(module), key_class)
+    for name in RSA_BACKENDS:
+        try:
+            return get_key_backend(name)
+        except ImportError:
+            continue
+    raise ImportError('No RSA backend available for python-jose.')
+
+
+def parse_max_age(cache_control):
+    ''' Return the max-age (in seconds) of a Cache-Control header, 0 if it
+    forbids caching, None if it does not say anything about it '''
+    if not cache_control:
+        return None
+    directives = cache_control.lower()
+    if 'no-store' in directives or 'no-cache' in directives:
+        return 0
+    match = MAX_AGE.search(directives)
+    if match:
+        return int(match.group(1))
+    return None
+
+
+class CircuitOpenError(Exception):
+    ''' Raised instead of fetching the key set while the circuit is open '''
+
+
+class JWKSFetcher:
+    ''' Download a key set with bounded connect and read timeouts, behind a
+    circuit breaker.
+
+    After failure_threshold consecutive failures the circuit opens and every
+    fetch fails fast for reset_timeout seconds, then a single trial fetch is
+    let through (half-open): its success closes the circuit again. '''
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, url, connect_timeout=2.0, read_timeout=3.0,
+                 failure_threshold=3, reset_timeout=30):
+        self.url = url
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        # metrics
+        self.fetches = 0
+        self.errors = 0
+        self.rejections = 0
+        self.last_latency = None
+        self.max_latency = 0.0
+        self.total_latency = 0.0
+        self._lock = threading.Lock()
+        # a lock held by another thread while forking would never be released
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+    def __call__(self):
+        ''' Return the downloaded key set along with its max-age '''
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    self.rejections += 1
+                    raise CircuitOpenError(f'JWKS circuit open: {self.url}')
+                self.state = self.HALF_OPEN
+        start = time.monotonic()
+        try:
+            result = self._download()
+        except Exception:
+            self._record(time.monotonic() - start, failed=True)
+            raise
+        self._record(time.monotonic() - start, failed=False)
+        return result
+
+    def _download(self):
+        url = urlsplit(self.url)
+        if url.scheme == 'https':
+            connection_class = http.client.HTTPSConnection
+        else:
+            connection_class = http.client.HTTPConnection
+        connection = connection_class(url.hostname, url.port,
+                                      timeout=self.connect_timeout)
+        try:
+            connection.connect()
+            connection.sock.settimeout(self.read_timeout)
+            connection.request('GET', url.path or '/',
+                               headers={'Accept': 'application/json'})
+            response = connection.getresponse()
+            body = response.read()
+            if response.status != 200:
+                raise IOError(f'JWKS download failed: HTTP {response.status}')
+            return (json.loads(body),
+                    parse_max_age(response.getheader('Cache-Control')))
+        finally:
+            connection.close()
+
+    def _record(self, latency, failed):
+        with self._lock:
+            self.fetches += 1
+            self.last_latency = latency
+            self.max_latency = max(self.max_latency, latency)
+            self.total_latency += latency
+            if not failed:
+                self.state = self.CLOSED
+                self.failures = 0
+                return
+            self.errors += 1
+            self.failures += 1
+            if (self.state == self.HALF_OPEN
+                    or self.failures >= self.failure_threshold):
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def stats(self):
+        ''' Return the fetch latency and circuit breaker metrics '''
+        return {
+            'state': self.state,
+            'consecutive_failures': self.failures,
+            'fetches': self.fetches,
+            'errors': self.errors,
+            'rejections': self.rejections,
+            'last_latency': self.last_latency,
+            'max_latency': self.max_latency,
+            'average_latency':
+                self.total_latency / self.fetches if self.fetches else None,
+        }
+
+
+class JWKSFileFetcher:
+    ''' Read a key set from a local file instead of downloading it, for
+    hermetic tests and load tests (see local_issuer.py) '''
+
+    def __init__(self, path):
+        self.path = path
+        self.fetches = 0
+        self.errors = 0
+
+    def __call__(self):
+        ''' Return the key set read from the file, with no max-age '''
+        self.fetches += 1
+        try:
+            with open(self.path) as f:
+                return json.load(f), None
+        except Exception:
+            self.errors += 1
+            raise
+
+    def stats(self):
+        return {
+            'path': self.path,
+            'fetches': self.fetches,
+            'errors': self.errors,
+        }
+
+
+class JWKSStore:
+    ''' Process-wide cache of the Auth0 JSON Web Key Set, shared by all the
+    requests served by a worker.
+
+    - the key set is kept for the TTL advertised by the Cache-Control
+      header, clamped between min_ttl and max_ttl
+    - once expired, the stale key set keeps being served while a single
+      background thread fetches the new one (stale-while-revalidate)
+    - a token carrying an unknown kid triggers a synchronous refetch, at
+      most once every refetch_interval seconds
+
+    The public keys are parsed into key_class objects once per key set
+    version, so that verifying a signature does not rebuild them. Whenever
+    the fetcher fails, the last good key set keeps being served.
+    '''
+
+    def __init__(self, url, default_ttl=600, min_ttl=60, max_ttl=86400,
+                 refetch_interval=30, key_class=None, algorithm='RS256',
+                 fetcher=None):
+        self.url = url
+        self.fetcher = fetcher or JWKSFetcher(url)
+        self.key_class = key_class or get_key_backend()
+        self.algorithm = algorithm
+        self.default_ttl = default_ttl
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.refetch_interval = refetch_interval
+        # bumped whenever the downloaded key set differs from the cached one
+        self.version = 0
+        # callables invoked with no arguments whenever the version is bumped
+        self.listeners = []
+        self._jwks = None
+        self._keys = None
+        self._expires_at = 0
+        self._last_fetch = None
+        self._fetch_lock = threading.Lock()
+        self._revalidating = False
+        self._revalidating_lock = threading.Lock()
+        # a lock held by another thread while forking would never be released
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _after_fork(self):
+        self._fetch_lock = threading.Lock()
+        self._revalidating = False
+        self._revalidating_lock = threading.Lock()
+
+    def _fetch(self):
+        ''' Download the key set, return it along with its max-age '''
+        return self.fetcher()
+
+    def refresh(self):
+        ''' Download the key set and swap it in place of the cached one '''
+        with self._fetch_lock:
+            self._refresh()
+
+    def _refresh(self):
+        jwks, ttl = self._fetch()
+        if ttl is None:
+            ttl = self.default_ttl
+        ttl = min(max(ttl, self.min_ttl), self.max_ttl)
+        jwks = {key['kid']: key for key in jwks.get('keys', [])
+                if 'kid' in key}
+        rotated = jwks != self._jwks
+        if rotated:
+            self.version += 1
+            self._keys = self._construct_keys(jwks)
+            self._jwks = jwks
+        self._last_fetch = time.monotonic()
+        self._expires_at = self._last_fetch + ttl
+        if rotated:
+            for listener in self.listeners:
+                listener()
+
+    def _construct_keys(self, jwks):
+        ''' Return the {kid: key object} index of a key set, skipping the
+        keys which cannot be used to verify our signatures '''
+        keys = dict()
+        for kid, jwk in jwks.items():
+            if jwk.get('kty') != 'RSA' or jwk.get('use', 'sig') != 'sig':
+                continue
+            try:
+                keys[kid] = self.key_class(jwk, jwk.get('alg', self.algorithm))
+            except Exception:
+                continue
+        return keys
+
+    def warm_up(self):
+        ''' Fetch the key set unless already cached, return True if a key
+        set is available '''
+        try:
+            self.keys()
+        except Exception:
+            return False
+        return True
+
+    def keys(self):
+        ''' Return the cached {kid: key object} mapping, fetching it if
+        needed '''
+        if self._keys is None:
+            with self._fetch_lock:
+                if self._keys is None:  # not fetched by another thread
+                    self._refresh()
+        elif time.monotonic() >= self._expires_at:
+            self._revalidate()
+        return self._keys
+
+    def get_key(self, kid):
+        ''' Return the key object matching the given kid, None if there is
+        none '''
+        key = self.keys().get(kid)
+        if key is None:
+            self._refetch_unknown_kid()
+            key = self._keys.get(kid)
+        return key
+
+    def _refetch_unknown_kid(self):
+        ''' Refetch the key set unless it has been fetched recently '''
+        with self._fetch_lock:
+            if time.monotonic() - self._last_fetch < self.refetch_interval:
+                return
+            try:
+                self._refresh()
+            except Exception:
+                # rate limit the failed attempts as well
+                self._last_fetch = time.monotonic()
+
+    def stats(self):
+        ''' Return the key set and fetcher metrics '''
+        expires_in = None
+        if self._keys is not None:
+            expires_in = self._expires_at - time.monotonic()
+        return {
+            'version': self.version,
+            'keys': len(self._keys or ()),
+            'expires_in': expires_in,
+            'fetcher': self.fetcher.stats(),
+        }
+
+    def _revalidate(self):
+        ''' Refresh the key set in a background thread, unless already
+        doing so '''
+        with self._revalidating_lock:
+            if self._revalidating:
+                return
+            self._revalidating = True
+        threading.Thread(target=self._background_refresh, daemon=True).start()
+
+    def _background_refresh(self):
+        try:
+            self.refresh()
+        except Exception:
+            # keep serving the last good key set, retry a bit later
+            self._expires_at = time.monotonic() + self.refetch_interval
+        finally:
+            with self._revalidating_lock:
+                self._revalidating = False
+
+
+class JWKSRefresher:
+    ''' Keep a JWKSStore current from a daemon thread, so that requests
+    never have to wait for the key set to be downloaded.
+
+    The key set is refreshed `lead` seconds before it expires, or `retry`
+    seconds after a failed attempt. The thread is restarted in the child
+    processes forked after it was started (e.g. the gunicorn workers of a
+    preloaded app). '''
+
+    def __init__(self, store, lead=10, retry=5):
+        self.store = store
+        self.lead = lead
+        self.retry = retry
+        self.refreshes = 0
+        self.errors = 0
+        self._thread = None
+        self._stopped = threading.Event()
+        self._registered = False
+
+    def start(self):
+        ''' Start the refresher thread, unless already running '''
+        if self._thread is not None and self._thread.is_alive():
+            return
+        if not self._registered:
+            os.register_at_fork(after_in_child=self._after_fork)
+            self._registered = True
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='jwks-refresher')
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _after_fork(self):
+        # threads do not survive a fork, start a new one in the child
+        if self._thread is not None and not self._stopped.is_set():
+            self._thread = None
+            self.start()
+
+    def _delay(self):
+        ''' Return the seconds to wait before the next refresh '''
+        if self.store._keys is None:
+            return 0
+        return max(self.store._expires_at - time.monotonic() - self.lead,
+                   self.retry)
+
+    def _run(self):
+        while not self._stopped.wait(self._delay()):
+            try:
+                self.store.refresh()
+                self.refreshes += 1
+            except Exception:
+                self.errors += 1
+                self._stopped.wait(self.retry)
+
+    def stats(self):
+        return {
+            'running': self.running,
+            'refreshes': self.refreshes,
+            'errors': self.errors,
+        }
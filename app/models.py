@@ -1,24 +1,108 @@
+import os
+import weakref
 from datetime import datetime
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool, QueuePool
 
+from app.routing import RoutingSQLAlchemy
 
-db = SQLAlchemy()
+
+db = RoutingSQLAlchemy()
+
+
+# the connections of a pool must never be shared by the processes forked
+# from the one which opened them (the gunicorn workers of a preloaded app)
+
+# engines which have connected, see dispose_pools()
+engines = weakref.WeakSet()
+
+
+@event.listens_for(Engine, 'engine_connect')
+def track_engine(connection, branch):
+    engines.add(connection.engine)
+
+
+def dispose_pools():
+    ''' Close the idle server connections before forking, so that the
+    children do not inherit them (the pools of the in-memory SQLite
+    databases, which hold the database itself, are left alone). Called by
+    the pre_fork hook of gunicorn.conf.py. '''
+    for engine in list(engines):
+        if isinstance(engine.pool, QueuePool):
+            engine.dispose()
+
+
+@event.listens_for(Pool, 'connect')
+def record_connection_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+
+@event.listens_for(Pool, 'checkout')
+def check_connection_pid(dbapi_connection, connection_record,
+                         connection_proxy):
+    ''' Replace the connections inherited from the parent process (those
+    checked out while forking) instead of using them '''
+    if connection_record.info['pid'] != os.getpid():
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError(
+            'Connection opened by another process, replaced.')
+
+
+class FormatMixin:
+    ''' format() and the loader options it needs, for the models whose
+    keys are the COLUMNS, formatted as they are, and the EMBEDDED lists,
+    loaded from relationships. Each model gives the loader options and the
+    formatting of its embedded lists in embedded_options() and
+    format_embedded(). '''
+    COLUMNS = ()
+    EMBEDDED = ()
+
+    @classmethod
+    def format_options(cls, fields=None):
+        ''' Loader options fetching everything format(fields) needs in a
+        fixed number of queries, whatever the number of rows. The columns
+        and relationships not requested are not loaded at all. '''
+        fields = fields or cls.COLUMNS + cls.EMBEDDED
+        options = [db.load_only(*[x for x in cls.COLUMNS if x in fields])]
+        return options + cls.embedded_options(fields)
+
+    @classmethod
+    def embedded_options(cls, fields):
+        return []
+
+    def format(self, fields=None):
+        fields = fields or self.COLUMNS + self.EMBEDDED
+        formatted = {x: getattr(self, x) for x in self.COLUMNS if x in fields}
+        formatted.update(self.format_embedded(fields))
+        return formatted
+
+    def format_embedded(self, fields):
+        return {}
 
 
 # simple m2m association table between Movie and Genre
 movie_genre = db.Table(
     'movie_genre',
-    db.Column('movie_id', db.Integer, db.ForeignKey('movies.id')),
-    db.Column('genre_id', db.Integer, db.ForeignKey('genres.id'))
+    db.Column('movie_id', db.Integer, db.ForeignKey('movies.id'),
+              primary_key=True),
+    db.Column('genre_id', db.Integer, db.ForeignKey('genres.id'),
+              primary_key=True, index=True)
 )
 
 
-class Movie(db.Model):
+class Movie(FormatMixin, db.Model):
     __tablename__ = 'movies'
+    # serves both the release date ranges and the keyset pagination of the
+    # movies sorted by release date
+    __table_args__ = (
+        db.Index('ix_movies_release_date_id', 'release_date', 'id'),
+    )
     id = db.Column(db.Integer, primary_key=True)
-    title = db.Column(db.String(120))
+    title = db.Column(db.String(120), index=True)
     release_date = db.Column(db.DateTime, default=datetime.utcnow())
-    genre = db.relationship('Genre', secondary=movie_genre, backref='movie')
+    genre = db.relationship('Genre', secondary=movie_genre,
+                            back_populates='movie')
     interpretation = db.relationship('Interpretation', back_populates='movie')
 
     def insert(self):
@@ -32,42 +116,64 @@ class Movie(db.Model):
         db.session.delete(self)
         db.session.commit()
 
-    def format(self):
-        genres = [genre.name for genre in self.genre]
-        cast = {x.actor.name + ' ' + x.actor.surname: x.character
+    COLUMNS = ('title', 'release_date')
+    EMBEDDED = ('genre', 'interpretation')
+
+    @classmethod
+    def embedded_options(cls, fields):
+        options = []
+        if 'genre' in fields:
+            options.append(db.selectinload(cls.genre).load_only('name'))
+        if 'interpretation' in fields:
+            options.append(db.selectinload(cls.interpretation)
+                             .joinedload(Interpretation.actor)
+                             .load_only('name', 'surname'))
+        return options
+
+    def format_embedded(self, fields):
+        formatted = {}
+        if 'genre' in fields:
+            formatted['genre'] = [genre.name for genre in self.genre]
+        if 'interpretation' in fields:
+            formatted['interpretation'] = {
+                x.actor.name + ' ' + x.actor.surname: x.character
                 for x in self.interpretation}
-        return {
-            'title': self.title,
-            'release_date': self.release_date,
-            'genre': genres,
-            'interpretation': cast,
-        }
+        return formatted
 
     def __repr__(self):
         return f"<{self.id}, {self.title}, {self.release_date}>"
 
 
-class Genre(db.Model):
+class Genre(FormatMixin, db.Model):
     __tablename__ = 'genres'
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(120))
+    movie = db.relationship('Movie', secondary=movie_genre,
+                            back_populates='genre')
 
-    def format(self):
-        movies = [movie.title for movie in self.movie]
-        return {
-            'name': self.name,
-            'movies': movies
-        }
+    COLUMNS = ('name',)
+    EMBEDDED = ('movies',)
+
+    @classmethod
+    def embedded_options(cls, fields):
+        if 'movies' in fields:
+            return [db.selectinload(cls.movie).load_only('title')]
+        return []
+
+    def format_embedded(self, fields):
+        if 'movies' in fields:
+            return {'movies': [movie.title for movie in self.movie]}
+        return {}
 
     def __repr__(self):
         return f"<{self.id}, {self.name}>"
 
 
-class Actor(db.Model):
+class Actor(FormatMixin, db.Model):
     __tablename__ = 'actors'
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(120))
-    surname = db.Column(db.String(120))
+    surname = db.Column(db.String(120), index=True)
     dob = db.Column(db.DateTime, default=datetime.utcnow())
     gender = db.Column(db.String(10))
     interpretation = db.relationship('Interpretation', back_populates='actor')
@@ -83,16 +189,22 @@ class Actor(db.Model):
         db.session.delete(self)
         db.session.commit()
 
-    def format(self):
-        filmography = {x.movie.title : x.character for x in self.interpretation}
+    COLUMNS = ('name', 'surname', 'dob', 'gender')
+    EMBEDDED = ('filmography',)
 
-        return {
-            'name': self.name,
-            'surname': self.surname,
-            'dob': self.dob,
-            'gender': self.gender,
-            'filmography': filmography
-        }
+    @classmethod
+    def embedded_options(cls, fields):
+        if 'filmography' in fields:
+            return [db.selectinload(cls.interpretation)
+                      .joinedload(Interpretation.movie)
+                      .load_only('title')]
+        return []
+
+    def format_embedded(self, fields):
+        if 'filmography' in fields:
+            return {'filmography': {
+                x.movie.title: x.character for x in self.interpretation}}
+        return {}
 
     def __repr__(self):
         return f"<{self.id}, {self.name} {self.surname}, {self.dob}, {self.gender}>"
@@ -104,11 +216,27 @@ class Interpretation(db.Model):
     by the "character" field '''
     __tablename__ = 'interpretations'
     id = db.Column(db.Integer, primary_key=True)
-    movie_id = db.Column(db.Integer, db.ForeignKey(Movie.id))
-    actor_id = db.Column(db.Integer, db.ForeignKey(Actor.id))
+    movie_id = db.Column(db.Integer, db.ForeignKey(Movie.id), index=True)
+    actor_id = db.Column(db.Integer, db.ForeignKey(Actor.id), index=True)
     character = db.Column(db.String(120))
     movie = db.relationship('Movie', back_populates='interpretation')
     actor = db.relationship('Actor', back_populates='interpretation')
 
+    @classmethod
+    def format_options(cls):
+        ''' Loader options fetching the movie and actor format() needs
+        along with the interpretations '''
+        return (
+            db.joinedload(cls.movie).load_only('title'),
+            db.joinedload(cls.actor).load_only('name', 'surname'),
+        )
+
+    def format(self):
+        return {
+            'character': self.character,
+            'movie': self.movie.title,
+            'actor': self.actor.name + ' ' + self.actor.surname,
+        }
+
     def __repr__(self):
         return f"<{self.id}, movie {self.movie_id}, actor {self.actor_id}, {self.character}>"
@@ -0,0 +1,287 @@
+import logging
+import os
+import select
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool
+
+from app.cache import LRUCache
+from app.models import db
+from app.routing import get_replicas
+
+
+logger = logging.getLogger(__name__)
+
+# channel of the notifications of the table versions, "<table>:<version>"
+VERSIONS_CHANNEL = 'table_versions'
+
+# channel of the writes of the subjects of the tokens, whose reads go to the
+# primary until the replicas have replayed them, "<subject>"
+WRITERS_CHANNEL = 'writers'
+
+# every table of the models is versioned
+VERSIONED_TABLES = list(db.metadata.tables)
+
+
+def sequence(table):
+    ''' Return the name of the sequence versioning table '''
+    return f'{table}_version'
+
+
+class TableVersions:
+    ''' Versions of the tables, held in the memory of the worker.
+
+    Every statement writing to a table takes the next value of the table's
+    sequence, which is notified to the listeners when the transaction
+    commits (see the 5b0f3c2e9a41 migration). A sequence is not
+    transactional, so the writers do not hold a lock until they commit, and
+    the versions only move once the writes are visible. Given the same
+    notifications, in commit order, every worker of every dyno has the same
+    versions, including for the writes made outside the app.
+
+    A version taken by a transaction which commits after a greater one
+    (or which was in flight when the versions were loaded) comes too late:
+    the responses read meanwhile are stored under the current version. The
+    table then gets a new value of its sequence instead. '''
+
+    def __init__(self):
+        self.notifications = 0
+        self.reordered = 0
+        self._versions = None
+        self._lock = threading.Lock()
+
+    def load(self, versions):
+        ''' Replace the versions by those of the {table: version} mapping,
+        None while they are unknown '''
+        with self._lock:
+            self._versions = None if versions is None else dict(versions)
+
+    def get(self, tables):
+        ''' Return the tuple of the versions of tables, None while they are
+        unknown (the listener is not connected) '''
+        versions = self._versions
+        if versions is None:
+            return None
+        return tuple(versions[x] for x in tables)
+
+    def notified(self, payload, nextval):
+        ''' Apply a notification, nextval(table) returning a new value of
+        the table's sequence '''
+        table, version = payload.rsplit(':', 1)
+        version = int(version)
+        with self._lock:
+            if self._versions is None:
+                return
+            self.notifications += 1
+            if version <= self._versions[table]:
+                self.reordered += 1
+                version = nextval(table)
+            self._versions[table] = version
+
+    def stats(self):
+        return {
+            'loaded': self._versions is not None,
+            'notifications': self.notifications,
+            'reordered': self.reordered,
+        }
+
+
+class Listener:
+    ''' Listen to the notifications of the primary database, from a daemon
+    thread of each worker: the versions of the tables, and the time of the
+    last write of the token subjects, in `writers`.
+
+    The thread is started by the first request of each process (threads
+    do not survive a fork, and the preloaded gunicorn master never serves
+    any), on a connection of its own. It loads the versions once listening,
+    so that no commit falls in between, and takes new ones after
+    reconnecting, the notifications sent meanwhile being lost. The SQLite
+    databases of the tests notify from the process itself, as they commit.
+    '''
+
+    def __init__(self, versions, writers, retry=5, keepalive=60):
+        self.versions = versions
+        self.writers = writers
+        self.retry = retry
+        self.keepalive = keepalive
+        self.errors = 0
+        self._pid = None
+        self._nextval = None
+        self._lock = threading.Lock()
+
+    def start(self, engine):
+        ''' Start listening in this process, unless already doing so '''
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            if engine.dialect.name == 'sqlite':
+                self._nextval = sqlite_table_nextval
+                self.versions.load({x: sqlite_sequences[sequence(x)]
+                                    for x in VERSIONED_TABLES})
+                return
+            self.versions.load(None)
+            threading.Thread(target=self._run, args=(engine,), daemon=True,
+                             name='notifications-listener').start()
+
+    def dispatch(self, channel, payload):
+        ''' Apply a notification '''
+        if channel == VERSIONS_CHANNEL:
+            self.versions.notified(payload, self._nextval)
+        elif channel == WRITERS_CHANNEL:
+            self.writers.set(payload, time.time())
+
+    def _run(self, engine):
+        reconnect = False
+        while True:
+            try:
+                self._listen(engine, reconnect)
+            except Exception:
+                self.errors += 1
+                logger.exception('Lost the database notifications, '
+                                 'reconnecting in %s seconds.', self.retry)
+            self.versions.load(None)
+            reconnect = True
+            time.sleep(self.retry)
+
+    def _listen(self, engine, reconnect):
+        connection = engine.raw_connection()
+        connection.detach()  # kept for good, out of the pool
+        dbapi_connection = connection.connection
+        try:
+            dbapi_connection.autocommit = True
+            cursor = dbapi_connection.cursor()
+            cursor.execute(f'LISTEN {VERSIONS_CHANNEL}; '
+                           f'LISTEN {WRITERS_CHANNEL}')
+
+            def nextval(table):
+                cursor.execute('SELECT nextval(%s)', (sequence(table),))
+                return cursor.fetchone()[0]
+            if reconnect:
+                versions = {x: nextval(x) for x in VERSIONED_TABLES}
+            else:
+                cursor.execute(' UNION ALL '.join(
+                    f"SELECT '{x}', last_value FROM {sequence(x)}"
+                    for x in VERSIONED_TABLES))
+                versions = dict(cursor.fetchall())
+            self._nextval = nextval
+            self.versions.load(versions)
+            while True:
+                if select.select([dbapi_connection], [], [],
+                                 self.keepalive)[0]:
+                    dbapi_connection.poll()
+                else:
+                    cursor.execute('SELECT 1')  # a dead connection raises
+                while dbapi_connection.notifies:
+                    notify = dbapi_connection.notifies.pop(0)
+                    self.dispatch(notify.channel, notify.payload)
+        finally:
+            dbapi_connection.close()
+
+    def stats(self):
+        stats = self.versions.stats()
+        stats['errors'] = self.errors
+        return stats
+
+
+table_versions = TableVersions()
+# time of the last write of the most recent writers
+recent_writers = LRUCache(maxsize=10000)
+listener = Listener(table_versions, recent_writers)
+
+
+@event.listens_for(db.session, 'before_commit')
+def notify_writer(session):
+    ''' Notify the subject of the token of a write request, along with its
+    writes, when there are replicas which may not have replayed them yet '''
+    if has_request_context() \
+            and request.method not in ('GET', 'HEAD', 'OPTIONS') \
+            and g.get('subject') and get_replicas(current_app):
+        session.execute(db.text('SELECT pg_notify(:channel, :subject)'),
+                        {'channel': WRITERS_CHANNEL, 'subject': g.subject})
+
+
+# POSTGRESQL -----------------------------------------------------------
+
+NOTIFY_FUNCTION = f'''
+    CREATE OR REPLACE FUNCTION notify_table_version() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('{VERSIONS_CHANNEL}', TG_TABLE_NAME || ':' ||
+                          nextval((TG_TABLE_NAME || '_version')::regclass));
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql'''
+
+
+@event.listens_for(db.metadata, 'after_create')
+def create_version_triggers(metadata, connection, tables=(), **kw):
+    ''' Create the sequences versioning the tables just created, and their
+    triggers: the databases created by create_all() (those of the tests)
+    get the same ones as those created by the migrations. SQLite has no
+    statement level triggers, so its triggers notify every row written. '''
+    tables = [x.name for x in tables if x.name in VERSIONED_TABLES]
+    if tables and connection.dialect.name == 'postgresql':
+        connection.execute(NOTIFY_FUNCTION)
+    for table in tables:
+        if connection.dialect.name == 'postgresql':
+            connection.execute(
+                f'CREATE SEQUENCE IF NOT EXISTS {sequence(table)}')
+            connection.execute(
+                f'CREATE TRIGGER notify_version '
+                f'AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table} '
+                f'FOR EACH STATEMENT EXECUTE FUNCTION notify_table_version()')
+        elif connection.dialect.name == 'sqlite':
+            for operation in ('INSERT', 'UPDATE', 'DELETE'):
+                connection.execute(
+                    f'CREATE TRIGGER notify_{table}_version_'
+                    f'{operation.lower()} AFTER {operation} ON {table} '
+                    f"BEGIN SELECT pg_notify('{VERSIONS_CHANNEL}', "
+                    f"'{table}:' || nextval('{sequence(table)}')); END")
+
+
+# SQLITE ---------------------------------------------------------------
+
+# the SQLite databases emulate the sequences and the notifications, which
+# are delivered by the process itself when the transaction commits
+sqlite_sequences = defaultdict(int)
+
+
+def sqlite_nextval(name):
+    sqlite_sequences[name] += 1
+    return sqlite_sequences[name]
+
+
+def sqlite_table_nextval(table):
+    return sqlite_nextval(sequence(table))
+
+
+@event.listens_for(Pool, 'connect')
+def create_sqlite_functions(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+
+    def pg_notify(channel, payload):
+        connection_record.info.setdefault('notifications', []) \
+                              .append((channel, payload))
+    dbapi_connection.create_function('nextval', 1, sqlite_nextval)
+    dbapi_connection.create_function('pg_notify', 2, pg_notify)
+
+
+@event.listens_for(Engine, 'commit')
+def deliver_notifications(connection):
+    for channel, payload in connection.connection.info.pop('notifications',
+                                                           ()):
+        listener.dispatch(channel, payload)
+
+
+@event.listens_for(Engine, 'rollback')
+def discard_notifications(connection):
+    connection.connection.info.pop('notifications', None)
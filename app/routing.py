@@ -0,0 +1,32 @@
+from flask import g, has_app_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import orm
+
+
+def get_replicas(app):
+    ''' Get the binds of the read replicas, see DATABASE_REPLICA_URLS '''
+    return [x for x in app.config['SQLALCHEMY_BINDS'] or ()
+            if x.startswith('replica')]
+
+
+class RoutingSession(SignallingSession):
+    ''' Session sending its queries to the read replica bind chosen for the
+    current request (g.replica, see create_app), if any, and to the primary
+    database otherwise. Flushes always go to the primary. '''
+
+    def __init__(self, db, **options):
+        self.db = db
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        replica = g.get('replica') if has_app_context() else None
+        if replica is not None and not self._flushing:
+            return self.db.get_engine(self.app, bind=replica)
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    ''' Flask-SQLAlchemy extension whose sessions can read from replicas '''
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
@@ -0,0 +1,115 @@
+from app.models import db, Movie, Actor, Interpretation
+
+
+# ranked full-text matches of each searchable table, against the generated
+# search_vector columns and their GIN indexes (see the 9e817b81c656
+# migration); the text search configuration must match the column's one
+FULL_TEXT_MATCHES = {
+    'movie': '''
+        SELECT 'movie' AS type, id, ts_rank(search_vector, query) AS rank
+        FROM movies, websearch_to_tsquery('english', :q) query
+        WHERE search_vector @@ query''',
+    'actor': '''
+        SELECT 'actor' AS type, id, ts_rank(search_vector, query) AS rank
+        FROM actors, websearch_to_tsquery('simple', :q) query
+        WHERE search_vector @@ query''',
+    'interpretation': '''
+        SELECT 'interpretation' AS type, id,
+               ts_rank(search_vector, query) AS rank
+        FROM interpretations, websearch_to_tsquery('simple', :q) query
+        WHERE search_vector @@ query''',
+}
+
+
+def load_results(matches):
+    ''' Return the formatted search results of the (type, id, score)
+    matches, loading the entities of each type in a single query '''
+    ids = {'movie': [], 'actor': [], 'interpretation': []}
+    for type_, id_, _ in matches:
+        ids[type_].append(id_)
+
+    entities = dict()
+    if ids['movie']:
+        query = Movie.query.options(*Movie.format_options(Movie.COLUMNS))
+        for movie in query.filter(Movie.id.in_(ids['movie'])):
+            entities['movie', movie.id] = movie.format(Movie.COLUMNS)
+    if ids['actor']:
+        query = Actor.query.options(*Actor.format_options(Actor.COLUMNS))
+        for actor in query.filter(Actor.id.in_(ids['actor'])):
+            entities['actor', actor.id] = actor.format(Actor.COLUMNS)
+    if ids['interpretation']:
+        query = Interpretation.query.options(
+            *Interpretation.format_options())
+        for x in query.filter(Interpretation.id.in_(ids['interpretation'])):
+            entities['interpretation', x.id] = x.format()
+
+    results = []
+    for type_, id_, score in matches:
+        entity = entities.get((type_, id_))
+        if entity is not None:  # unless deleted in the meantime
+            results.append({
+                'type': type_,
+                'id': id_,
+                'score': score,
+                type_: entity,
+            })
+    return results
+
+
+def full_text_search(q, types, limit, after=None):
+    ''' Return the first limit formatted results matching the q web search
+    query, ordered by (rank descending, type, id), along with the (rank,
+    type, id) cursor of the next page (None on the last page). Given such a
+    cursor, after, only the results following it are returned: unlike
+    OFFSET, the deep pages do not go through the previous ones. '''
+    sql = ' UNION ALL '.join(FULL_TEXT_MATCHES[x] for x in types)
+    sql = f'SELECT type, id, rank FROM ({sql}) matches'
+    params = {'q': q, 'limit': limit + 1}
+    if after is not None:
+        sql += ''' WHERE rank < CAST(:rank AS real)
+                   OR (rank = CAST(:rank AS real)
+                       AND (type, id) > (:type, :id))'''
+        params.update(zip(('rank', 'type', 'id'), after))
+    sql += ' ORDER BY rank DESC, type, id LIMIT :limit'
+    matches = db.session.execute(db.text(sql), params).fetchall()
+    if len(matches) > limit:
+        return load_results(matches[:limit]), tuple(matches[limit - 1])
+    return load_results(matches), None
+
+
+# nearest trigram matches of each table, against the GiST trigram indexes
+# (see the 47e1a20dae98 migration); the looked up text must be the indexed
+# expression. word_similarity() matches the query against the most similar
+# part of the text, so that a misspelled surname alone finds the actor.
+FUZZY_MATCHES = {
+    'movie': '''
+        SELECT 'movie' AS type, id, word_similarity(:q, title) AS score
+        FROM movies
+        WHERE :q <% title
+        ORDER BY :q <<-> title
+        LIMIT :limit''',
+    'actor': '''
+        SELECT 'actor' AS type, id,
+               word_similarity(:q, (coalesce(name, '') || ' ' ||
+                                    coalesce(surname, ''))) AS score
+        FROM actors
+        WHERE :q <% (coalesce(name, '') || ' ' || coalesce(surname, ''))
+        ORDER BY :q <<-> (coalesce(name, '') || ' ' || coalesce(surname, ''))
+        LIMIT :limit''',
+}
+
+
+def fuzzy_lookup(q, type_, limit, threshold):
+    ''' Return the formatted limit entities of type_ whose name is the most
+    similar to q, most similar first, ignoring those scoring below
+    threshold (between 0 and 1) '''
+    # local to the request transaction
+    db.session.execute(
+        db.text("SELECT set_config('pg_trgm.word_similarity_threshold', "
+                ":threshold, true)"),
+        {'threshold': str(threshold)})
+    matches = db.session.execute(db.text(FUZZY_MATCHES[type_]), {
+        'q': q,
+        'limit': limit,
+    }).fetchall()
+    return load_results(matches)
@@ -0,0 +1,47 @@
+import json
+from datetime import date
+
+from flask import current_app
+from flask.json import JSONEncoder as FlaskJSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class JSONEncoder(FlaskJSONEncoder):
+    ''' Flask's encoder writing the dates as ISO 8601 strings, as orjson
+    does, instead of RFC 822 ones '''
+
+    def default(self, o):
+        if isinstance(o, date):  # datetimes included
+            return o.isoformat()
+        return super().default(o)
+
+
+def dumps(obj, indent=False, sort_keys=False):
+    ''' Serialize obj to JSON bytes, with orjson when installed (which
+    handles the dates natively, in the same pass), with the standard
+    library otherwise '''
+    if orjson is not None:
+        option = orjson.OPT_INDENT_2 if indent else 0
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, option=option)
+    return json.dumps(obj, cls=JSONEncoder, ensure_ascii=False,
+                      indent=2 if indent else None,
+                      separators=None if indent else (',', ':'),
+                      sort_keys=sort_keys).encode('utf-8')
+
+
+def jsonify(obj):
+    ''' Replacement of flask.jsonify serializing obj with dumps(), pretty
+    printed in debug mode as well '''
+    config = current_app.config
+    body = dumps(obj,
+                 indent=config['JSONIFY_PRETTYPRINT_REGULAR']
+                 or current_app.debug,
+                 sort_keys=config['JSON_SORT_KEYS'])
+    return current_app.response_class(body + b'\n',
+                                      mimetype=config['JSONIFY_MIMETYPE'])
@@ -0,0 +1,76 @@
+''' Compare the serialization of a /movies page by Flask's jsonify and the
+app's encoder (orjson when installed, the standard library otherwise), the
+movies being formatted in both cases.
+
+run with `python -m benchmarks.json_encoding [movies] [iterations]`
+'''
+import sys
+import timeit
+from datetime import datetime
+
+import flask
+
+from app import create_app, serialization
+from app.models import Movie, Genre, Actor, Interpretation
+
+
+def make_movies(count):
+    ''' Return count transient movies, each with 2 genres and 5 actors '''
+    genres = [Genre(name=f'genre {i}') for i in range(20)]
+    actors = [Actor(name=f'name {i}', surname=f'surname {i}',
+                    dob=datetime(1950, 1, 1), gender='female')
+              for i in range(100)]
+    movies = []
+    for i in range(count):
+        movie = Movie(title=f'movie {i}', release_date=datetime(2000, 1, 1),
+                      genre=[genres[i % 20], genres[(i + 1) % 20]])
+        movie.interpretation = [
+            Interpretation(actor=actors[(i + j) % 100],
+                           character=f'character {i} {j}')
+            for j in range(5)]
+        movies.append(movie)
+    return movies
+
+
+def main(count=100, iterations=200):
+    app = create_app(testing=True)
+    app.debug = False  # no pretty printing
+    movies = make_movies(count)
+
+    def envelope():
+        return {'success': True, 'movie': [x.format() for x in movies],
+                'next': None}
+
+    formatted = envelope()
+    with app.app_context():
+        # Flask's default encoder, writing RFC 822 dates
+        app.json_encoder = flask.json.JSONEncoder
+        results = {
+            'flask.jsonify': lambda: flask.jsonify(formatted),
+            'format() + flask.jsonify': lambda: flask.jsonify(envelope()),
+        }
+        for label, function in results.items():
+            elapsed = timeit.timeit(function, number=iterations)
+            print(f'{label:<40} {elapsed / iterations * 1e3:10.3f} ms/page')
+
+        app.json_encoder = serialization.JSONEncoder
+        encoders = {'orjson': serialization.orjson, 'stdlib': None}
+        for name, module in encoders.items():
+            if name == 'orjson' and module is None:
+                continue
+            serialization.orjson = module
+            results = {
+                f'jsonify ({name})':
+                    lambda: serialization.jsonify(formatted),
+                f'format() + jsonify ({name})':
+                    lambda: serialization.jsonify(envelope()),
+            }
+            for label, function in results.items():
+                elapsed = timeit.timeit(function, number=iterations)
+                print(f'{label:<40} '
+                      f'{elapsed / iterations * 1e3:10.3f} ms/page')
+        serialization.orjson = encoders['orjson']
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,75 @@
+''' Compare the cost of verifying a RS256 token by rebuilding the rsa_key
+dict on every request against reusing pre-constructed key objects, for each
+installed python-jose RSA backend.
+
+run with `python -m benchmarks.jwt_verify [iterations]`
+'''
+import sys
+import time
+import timeit
+from unittest import mock
+
+import rsa
+from jose import jwt
+from jose.utils import long_to_base64
+
+from app import auth
+from app.jwks import RSA_BACKENDS, get_key_backend
+
+
+def make_key_pair(kid, bits=2048):
+    ''' Return a (jwk, private key PEM) throwaway key pair '''
+    public_key, private_key = rsa.newkeys(bits)
+    jwk = {
+        'kid': kid,
+        'kty': 'RSA',
+        'use': 'sig',
+        'n': long_to_base64(public_key.n).decode(),
+        'e': long_to_base64(public_key.e).decode(),
+    }
+    return jwk, private_key.save_pkcs1().decode()
+
+
+def main(iterations=1000):
+    jwk, private_key = make_key_pair('benchmark')
+    claims = {
+        'iss': 'https://example.com/',
+        'aud': 'movie',
+        'exp': time.time() + 3600,
+        'permissions': ['get:movies'],
+    }
+    token = jwt.encode(claims, private_key, algorithm='RS256',
+                       headers={'kid': 'benchmark'})
+    decode_args = {
+        'algorithms': ['RS256'],
+        'audience': 'movie',
+        'issuer': 'https://example.com/',
+    }
+
+    def current_path():
+        ''' the rsa_key dict is parsed again by python-jose on each call '''
+        rsa_key = {k: jwk[k] for k in ('kty', 'kid', 'use', 'n', 'e')}
+        jwt.decode(token, rsa_key, **decode_args)
+
+    results = {'rsa_key dict (default backend)': current_path}
+    for name in RSA_BACKENDS:
+        try:
+            key = get_key_backend(name)(jwk, 'RS256')
+        except ImportError:
+            continue
+
+        def preconstructed(key=key):
+            header = jwt.get_unverified_header(token)
+            auth.verify_signature(token, header, key)
+            jwt.decode(token, key, options={'verify_signature': False},
+                       **decode_args)
+        results[f'pre-constructed key ({name})'] = preconstructed
+
+    with mock.patch.object(auth, 'ALGORITHMS', ['RS256']):
+        for label, function in results.items():
+            elapsed = timeit.timeit(function, number=iterations)
+            print(f'{label:<40} {elapsed / iterations * 1e6:10.1f} us/token')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
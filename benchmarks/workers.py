@@ -0,0 +1,109 @@
+''' Compare the sync and gevent gunicorn workers serving the app against
+PostgreSQL: the same number of workers under the same concurrent load, the
+requests going to the search endpoint, which is not cached.
+
+Requires a migrated and populated database at DATABASE_URL (see
+populate.py); the tokens come from the local issuer, with no network access
+to Auth0.
+
+run with `python -m benchmarks.workers [requests] [concurrency] [workers]`
+'''
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from urllib.request import Request, urlopen
+
+import local_issuer
+
+
+QUERIES = ['the', 'love', 'war', 'man', 'night', 'king', 'city', 'star']
+
+
+def serve(worker_class, workers, env):
+    ''' Start gunicorn with the production app, return the process and the
+    URL it listens to once it accepts connections '''
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    server = subprocess.Popen(
+        [sys.executable, '-c', 'from gunicorn.app.wsgiapp import run; run()',
+         '-c', 'gunicorn.conf.py', '-k', worker_class, '-w', str(workers),
+         '-b', f'127.0.0.1:{port}', '--preload',
+         'app:create_app(production=True)'],
+        env=env)
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return server, f'http://127.0.0.1:{port}'
+        except OSError:
+            if server.poll() is not None:
+                sys.exit(f'gunicorn -k {worker_class} failed to start')
+            time.sleep(0.1)
+
+
+def load(url, token, requests, concurrency):
+    ''' Send requests from concurrency threads, return the elapsed seconds
+    and the sorted latencies '''
+    latencies = []
+    counter = iter(range(requests))
+    lock = threading.Lock()
+
+    def client():
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            request = Request(f'{url}/search?q={QUERIES[i % len(QUERIES)]}',
+                              headers={'Authorization': f'Bearer {token}'})
+            start = time.perf_counter()
+            with urlopen(request, timeout=60) as response:
+                response.read()
+            latencies.append(time.perf_counter() - start)
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start, sorted(latencies)
+
+
+def main(requests=2000, concurrency=50, workers=2):
+    if not os.getenv('DATABASE_URL'):
+        sys.exit('DATABASE_URL must point to a populated database')
+    directory = tempfile.TemporaryDirectory()
+    local_issuer.init(directory.name)
+    env = dict(os.environ, **{
+        'AUTH0_DOMAIN': 'localhost',
+        'AUTH0_ALGORITHMS': 'RS256',
+        'AUTH0_API_AUDIENCE': 'movie',
+        'AUTH0_JWKS_FILE': os.path.join(directory.name, 'jwks.json'),
+        'SECRET_KEY': os.getenv('SECRET_KEY', 'benchmark'),
+    })
+    os.environ.update(env)
+    token = local_issuer.mint_token(
+        'assistant', *local_issuer.load_signing_key(directory.name))
+
+    print(f'{requests} requests, {concurrency} clients, {workers} workers')
+    for worker_class in ('sync', 'gevent'):
+        server, url = serve(worker_class, workers, env)
+        try:
+            load(url, token, concurrency, concurrency)  # warm up
+            elapsed, latencies = load(url, token, requests, concurrency)
+        finally:
+            server.terminate()
+            server.wait()
+        p50 = latencies[len(latencies) // 2]
+        p99 = latencies[int(len(latencies) * 0.99)]
+        print(f'{worker_class:<8} {requests / elapsed:8.0f} requests/s   '
+              f'p50 {p50 * 1000:7.1f} ms   p99 {p99 * 1000:7.1f} ms')
+    directory.cleanup()
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,24 @@
+''' Gunicorn settings, read from the working directory by default '''
+import os
+
+
+# the sync workers serve a single request at a time each; the gevent ones
+# (WORKER_CLASS=gevent or -k gevent) switch to another request whenever one
+# waits for PostgreSQL or Auth0, see benchmarks/workers.py
+worker_class = os.getenv('WORKER_CLASS', 'sync')
+worker_connections = int(os.getenv('WORKER_CONNECTIONS', 1000))
+
+
+def pre_fork(server, worker):
+    # the idle connections of the master (e.g. opened by the preloaded app)
+    # are not to be shared with the new worker
+    from app.models import dispose_pools
+    dispose_pools()
+
+
+def post_fork(server, worker):
+    # whichever setting chose the worker class; the gevent worker patches
+    # the standard library by itself, but not psycopg2 nor the app's locks
+    if 'gevent' in server.cfg.worker_class_str:
+        from app.green import patch_worker
+        patch_worker()
@@ -0,0 +1,161 @@
+''' Local stand-in for the Auth0 issuer, to run the test suite and the load
+tests without any network access.
+
+It generates a RSA key pair whose public half is published as a JWKS
+document, and mints RS256 tokens carrying the same permissions as the
+Casting Assistant, Casting Director and Executive Producer Auth0 users.
+
+usage:
+    python local_issuer.py init             # generate the key pair
+    python local_issuer.py token <role>     # print a token for the role
+    python local_issuer.py exports          # print the AUTH0_JWT* exports
+    python local_issuer.py serve            # serve the JWKS over http
+
+see setup_local.sh for the environment variables pointing the API to it
+'''
+import argparse
+import json
+import os
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jose import jwt
+from jose.utils import long_to_base64
+
+
+DEFAULT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           '.local_issuer')
+
+# same permissions as the users set up in Auth0
+ROLE_PERMISSIONS = {
+    'assistant': ['get:actors', 'get:movies'],
+    'director': ['delete:actors', 'get:actors', 'get:movies', 'patch:actors',
+                 'patch:movies', 'post:actors'],
+    'executive': ['delete:actors', 'delete:movies', 'get:actors',
+                  'get:movies', 'patch:actors', 'patch:movies', 'post:actors',
+                  'post:movies'],
+    # not a user role: the monitoring client scraping /metrics
+    'monitoring': ['get:metrics'],
+}
+
+# environment variables holding the token of each role, see setup.sh
+ROLE_ENV = {
+    'assistant': 'AUTH0_JWT1',
+    'director': 'AUTH0_JWT2',
+    'executive': 'AUTH0_JWT3',
+}
+
+
+def generate_key_pair(kid=None, bits=2048):
+    ''' Return a new (private key PEM, public jwk) pair '''
+    kid = kid or uuid.uuid4().hex
+    private_key = rsa.generate_private_key(public_exponent=65537,
+                                           key_size=bits)
+    public_numbers = private_key.public_key().public_numbers()
+    private_pem = private_key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.TraditionalOpenSSL,
+        encryption_algorithm=serialization.NoEncryption(),
+    ).decode()
+    jwk = {
+        'kid': kid,
+        'kty': 'RSA',
+        'use': 'sig',
+        'alg': 'RS256',
+        'n': long_to_base64(public_numbers.n).decode(),
+        'e': long_to_base64(public_numbers.e).decode(),
+    }
+    return private_pem, jwk
+
+
+def init(directory=DEFAULT_DIR):
+    ''' Write a new key pair to directory: private.pem and jwks.json '''
+    os.makedirs(directory, exist_ok=True)
+    private_pem, jwk = generate_key_pair()
+    private_path = os.path.join(directory, 'private.pem')
+    with open(os.open(private_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                      0o600), 'w') as f:
+        f.write(private_pem)
+    with open(os.path.join(directory, 'jwks.json'), 'w') as f:
+        json.dump({'keys': [jwk]}, f, indent=2)
+
+
+def load_signing_key(directory=DEFAULT_DIR):
+    ''' Return the (private key PEM, kid) pair written by init() '''
+    with open(os.path.join(directory, 'private.pem')) as f:
+        private_pem = f.read()
+    with open(os.path.join(directory, 'jwks.json')) as f:
+        kid = json.load(f)['keys'][0]['kid']
+    return private_pem, kid
+
+
+def mint_token(role, private_pem, kid, expires_in=86400, domain=None,
+               audience=None):
+    ''' Return a RS256 token granting the permissions of role, with the
+    issuer and audience expected by app/auth.py '''
+    domain = domain or os.getenv('AUTH0_DOMAIN')
+    audience = audience or os.getenv('AUTH0_API_AUDIENCE')
+    now = int(time.time())
+    claims = {
+        'iss': f'https://{domain}/',
+        'sub': f'local|{role}',
+        'aud': audience,
+        'iat': now,
+        'exp': now + expires_in,
+        'scope': '',
+        'permissions': ROLE_PERMISSIONS[role],
+    }
+    return jwt.encode(claims, private_pem, algorithm='RS256',
+                      headers={'kid': kid})
+
+
+def serve(directory=DEFAULT_DIR, port=8765):
+    ''' Serve the JWKS at http://127.0.0.1:<port>/.well-known/jwks.json '''
+    with open(os.path.join(directory, 'jwks.json'), 'rb') as f:
+        body = f.read()
+
+    class JWKSHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/.well-known/jwks.json':
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Cache-Control', 'public, max-age=600')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), JWKSHandler)
+    print(f'Serving http://127.0.0.1:{port}/.well-known/jwks.json')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local Auth0 stand-in')
+    parser.add_argument('--dir', default=DEFAULT_DIR,
+                        help='directory holding the key pair')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('init', help='generate a new key pair')
+    token_parser = commands.add_parser('token', help='print a token')
+    token_parser.add_argument('role', choices=ROLE_PERMISSIONS)
+    token_parser.add_argument('--expires-in', type=int, default=86400)
+    commands.add_parser('exports', help='print the AUTH0_JWT* exports')
+    serve_parser = commands.add_parser('serve', help='serve the JWKS')
+    serve_parser.add_argument('--port', type=int, default=8765)
+    args = parser.parse_args()
+
+    if args.command == 'init':
+        init(args.dir)
+    elif args.command == 'token':
+        print(mint_token(args.role, *load_signing_key(args.dir),
+                         expires_in=args.expires_in))
+    elif args.command == 'exports':
+        signing_key = load_signing_key(args.dir)
+        for role, env in ROLE_ENV.items():
+            print(f'export {env}={mint_token(role, *signing_key)}')
+    elif args.command == 'serve':
+        serve(args.dir, args.port)
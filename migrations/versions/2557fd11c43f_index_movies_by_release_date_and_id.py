@@ -0,0 +1,35 @@
+"""index the movies by release date and id
+
+Revision ID: 2557fd11c43f
+Revises: 47e1a20dae98
+Create Date: 2026-10-18 21:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2557fd11c43f'
+down_revision = '47e1a20dae98'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the composite index serves the keyset pagination of the movies sorted
+    # by release date, and supersedes the plain release date one
+    with op.get_context().autocommit_block():
+        op.create_index('ix_movies_release_date_id', 'movies',
+                        ['release_date', 'id'],
+                        postgresql_concurrently=True)
+        op.drop_index('ix_movies_release_date', table_name='movies',
+                      postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.create_index('ix_movies_release_date', 'movies',
+                        ['release_date'], postgresql_concurrently=True)
+        op.drop_index('ix_movies_release_date_id', table_name='movies',
+                      postgresql_concurrently=True)
@@ -0,0 +1,45 @@
+"""add trigram indexes for the fuzzy lookups
+
+Revision ID: 47e1a20dae98
+Revises: 9e817b81c656
+Create Date: 2026-10-18 20:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '47e1a20dae98'
+down_revision = '9e817b81c656'
+branch_labels = None
+depends_on = None
+
+
+# (index name, table, looked up text), see app/search.py
+TRIGRAM_INDEXES = [
+    ('ix_movies_title_trgm', 'movies', 'title'),
+    ('ix_actors_full_name_trgm', 'actors',
+     "(coalesce(name, '') || ' ' || coalesce(surname, ''))"),
+]
+
+
+def upgrade():
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    # GiST rather than GIN: besides the % filters, it returns the rows
+    # nearest first (<<-> ordering), so only the top-N ones are read
+    with op.get_context().autocommit_block():
+        for name, table, text in TRIGRAM_INDEXES:
+            op.execute(
+                f'CREATE INDEX CONCURRENTLY {name} ON {table} '
+                f'USING gist ({text} gist_trgm_ops)'
+            )
+
+
+def downgrade():
+    # the pg_trgm extension is left installed, other database objects may
+    # depend on it
+    with op.get_context().autocommit_block():
+        for name, table, text in reversed(TRIGRAM_INDEXES):
+            op.drop_index(name, table_name=table,
+                          postgresql_concurrently=True)
@@ -0,0 +1,49 @@
+"""add the table version sequences, notified by triggers
+
+Revision ID: 5b0f3c2e9a41
+Revises: 2557fd11c43f
+Create Date: 2026-10-19 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5b0f3c2e9a41'
+down_revision = '2557fd11c43f'
+branch_labels = None
+depends_on = None
+
+
+# the versioned tables, see TableVersions in app/notifications.py
+TABLES = ['movie_genre', 'movies', 'genres', 'actors', 'interpretations']
+
+
+def upgrade():
+    for table in TABLES:
+        op.execute(f'CREATE SEQUENCE {table}_version')
+    # once per statement, however many rows it writes: the next value of
+    # the table's sequence, which no other writer waits for, is notified
+    # to the listening workers when the transaction commits
+    op.execute('''
+        CREATE FUNCTION notify_table_version() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify('table_versions', TG_TABLE_NAME || ':' ||
+                              nextval((TG_TABLE_NAME || '_version')::regclass));
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql''')
+    for table in TABLES:
+        op.execute(
+            f'CREATE TRIGGER notify_version '
+            f'AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON {table} '
+            f'FOR EACH STATEMENT EXECUTE FUNCTION notify_table_version()')
+
+
+def downgrade():
+    for table in TABLES:
+        op.execute(f'DROP TRIGGER notify_version ON {table}')
+    op.execute('DROP FUNCTION notify_table_version()')
+    for table in TABLES:
+        op.execute(f'DROP SEQUENCE {table}_version')
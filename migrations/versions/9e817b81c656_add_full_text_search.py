@@ -0,0 +1,48 @@
+"""add full-text search vectors
+
+Revision ID: 9e817b81c656
+Revises: d000456bdd2e
+Create Date: 2026-10-18 20:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9e817b81c656'
+down_revision = 'd000456bdd2e'
+branch_labels = None
+depends_on = None
+
+
+# (table, text search configuration, searched text), see app/search.py
+SEARCH_VECTORS = [
+    ('movies', 'english', "coalesce(title, '')"),
+    ('actors', 'simple', "coalesce(name, '') || ' ' || coalesce(surname, '')"),
+    ('interpretations', 'simple', 'coalesce("character", \'\')'),
+]
+
+
+def upgrade():
+    # generated columns (PostgreSQL 12+) are kept up to date by the database
+    # itself on every insert and update
+    for table, config, text in SEARCH_VECTORS:
+        op.execute(
+            f'ALTER TABLE {table} ADD COLUMN search_vector tsvector '
+            f"GENERATED ALWAYS AS (to_tsvector('{config}', {text})) STORED"
+        )
+    with op.get_context().autocommit_block():
+        for table, config, text in SEARCH_VECTORS:
+            op.create_index(f'ix_{table}_search_vector', table,
+                            ['search_vector'], postgresql_using='gin',
+                            postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for table, config, text in SEARCH_VECTORS:
+            op.drop_index(f'ix_{table}_search_vector', table_name=table,
+                          postgresql_concurrently=True)
+    for table, config, text in SEARCH_VECTORS:
+        op.drop_column(table, 'search_vector')
@@ -0,0 +1,72 @@
+"""add performance indexes and movie_genre primary key
+
+Revision ID: d000456bdd2e
+Revises: 1da7a313fce5
+Create Date: 2026-10-18 19:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd000456bdd2e'
+down_revision = '1da7a313fce5'
+branch_labels = None
+depends_on = None
+
+
+# (index name, table, columns)
+INDEXES = [
+    ('ix_interpretations_movie_id', 'interpretations', ['movie_id']),
+    ('ix_interpretations_actor_id', 'interpretations', ['actor_id']),
+    ('ix_movie_genre_genre_id', 'movie_genre', ['genre_id']),
+    ('ix_movies_title', 'movies', ['title']),
+    ('ix_movies_release_date', 'movies', ['release_date']),
+    ('ix_actors_surname', 'actors', ['surname']),
+]
+
+
+def upgrade():
+    # remove the rows which would violate the primary key
+    op.execute(
+        'DELETE FROM movie_genre '
+        'WHERE movie_id IS NULL OR genre_id IS NULL'
+    )
+    op.execute(
+        'DELETE FROM movie_genre a USING movie_genre b '
+        'WHERE a.ctid < b.ctid '
+        'AND a.movie_id = b.movie_id AND a.genre_id = b.genre_id'
+    )
+    op.alter_column('movie_genre', 'movie_id', existing_type=sa.Integer(),
+                    nullable=False)
+    op.alter_column('movie_genre', 'genre_id', existing_type=sa.Integer(),
+                    nullable=False)
+
+    # CREATE INDEX CONCURRENTLY does not lock the tables against writes, but
+    # cannot run inside a transaction
+    with op.get_context().autocommit_block():
+        op.create_index('movie_genre_pkey', 'movie_genre',
+                        ['movie_id', 'genre_id'], unique=True,
+                        postgresql_concurrently=True)
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns,
+                            postgresql_concurrently=True)
+
+    # promoting the unique index is instantaneous
+    op.execute(
+        'ALTER TABLE movie_genre ADD CONSTRAINT movie_genre_pkey '
+        'PRIMARY KEY USING INDEX movie_genre_pkey'
+    )
+
+
+def downgrade():
+    op.drop_constraint('movie_genre_pkey', 'movie_genre', type_='primary')
+    with op.get_context().autocommit_block():
+        for name, table, columns in reversed(INDEXES):
+            op.drop_index(name, table_name=table,
+                          postgresql_concurrently=True)
+    op.alter_column('movie_genre', 'genre_id', existing_type=sa.Integer(),
+                    nullable=True)
+    op.alter_column('movie_genre', 'movie_id', existing_type=sa.Integer(),
+                    nullable=True)
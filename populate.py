@@ -70,6 +70,11 @@ def populate_interpretations(to_add=interpretations):
 def populate_movie_genre(to_add=movie_genre_association):
     i = 0
     for item in to_add:
+        if (db.session.query(movie_genre)
+                .filter_by(movie_id=item.get('movie_id'),
+                           genre_id=item.get('genre_id'))
+                .first()):
+            continue  # (movie_id, genre_id) is the primary key
         i += 1
         stmt = movie_genre.insert().values(
             movie_id=item.get('movie_id'),
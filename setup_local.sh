@@ -0,0 +1,23 @@
+#!/bin/bash
+
+# execute with:
+# source setup_local.sh
+#
+# same as setup.sh, but the tokens are minted by local_issuer.py and their
+# signature is checked against its key set instead of Auth0's one
+
+echo Updating local issuer environment variables...
+
+export AUTH0_DOMAIN=localhost
+export AUTH0_ALGORITHMS=RS256
+export AUTH0_API_AUDIENCE=movie
+export AUTH0_JWKS_FILE="$(pwd)/.local_issuer/jwks.json"
+# alternatively, serve the key set with `python local_issuer.py serve` and:
+# export AUTH0_JWKS_URL=http://127.0.0.1:8765/.well-known/jwks.json
+
+if [ ! -f "$AUTH0_JWKS_FILE" ]; then
+    python local_issuer.py init
+fi
+eval "$(python local_issuer.py exports)"
+
+echo Setup complete.
@@ -271,3 +271,66 @@ class AssistantTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertEqual(data['success'], True)
         self.assertEqual(len(data['genre']), self.total_genres)
+
+    # SEARCH -----------------------------------------------------------
+
+    def test_search(self):
+        res = self.client().get('/search?q=sternwood',
+                                headers=[
+                                    ('Content-Type', 'application/json'),
+                                    ('Authorization', f'Bearer {self.jtw}')
+                                ])
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        characters = [x['interpretation']['character']
+                      for x in data['results']]
+        self.assertEqual(sorted(characters),
+                         ['Carmen Sternwood', 'Vivian Sternwood Rutledge'])
+
+    def test_search_ranking(self):
+        res = self.client().get('/search?q=bogart',
+                                headers=[
+                                    ('Content-Type', 'application/json'),
+                                    ('Authorization', f'Bearer {self.jtw}')
+                                ])
+        data = json.loads(res.data)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['results'][0]['type'], 'actor')
+        self.assertEqual(data['results'][0]['actor']['surname'], 'Bogart')
+        self.assertIsNone(data['next'])
+
+    def test_search_missing_query(self):
+        res = self.client().get('/search?q=',
+                                headers=[
+                                    ('Content-Type', 'application/json'),
+                                    ('Authorization', f'Bearer {self.jtw}')
+                                ])
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['error'], 400)
+
+    def test_lookup_actors(self):
+        res = self.client().get('/actors/lookup?q=bogrt',
+                                headers=[
+                                    ('Content-Type', 'application/json'),
+                                    ('Authorization', f'Bearer {self.jtw}')
+                                ])
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['results'][0]['actor']['surname'], 'Bogart')
+        scores = [x['score'] for x in data['results']]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+
+    def test_lookup_movies(self):
+        res = self.client().get('/movies/lookup?q=big%20slep&limit=1',
+                                headers=[
+                                    ('Content-Type', 'application/json'),
+                                    ('Authorization', f'Bearer {self.jtw}')
+                                ])
+        data = json.loads(res.data)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(len(data['results']), 1)
+        self.assertEqual(data['results'][0]['movie']['title'],
+                         'The Big Sleep')
@@ -0,0 +1,397 @@
+import os
+import socket
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import rsa
+from jose import jwt
+from jose.utils import long_to_base64
+
+import local_issuer
+from app import auth
+from app.cache import LRUCache
+from app.jwks import (CircuitOpenError, JWKSFetcher, JWKSFileFetcher,
+                      JWKSRefresher, JWKSStore, parse_max_age)
+
+
+# a few throwaway key pairs, small enough to be generated quickly
+KEY_PAIRS = {kid: rsa.newkeys(512) for kid in 'abc'}
+
+
+def make_jwk(kid):
+    ''' Return the public jwk of the throwaway key pair named kid '''
+    public_key, _ = KEY_PAIRS[kid]
+    return {
+        'kid': kid,
+        'kty': 'RSA',
+        'use': 'sig',
+        'alg': 'RS256',
+        'n': long_to_base64(public_key.n).decode(),
+        'e': long_to_base64(public_key.e).decode(),
+    }
+
+
+def make_token(kid, **claims):
+    ''' Return a RS256 token signed with the throwaway key pair named kid '''
+    _, private_key = KEY_PAIRS[kid]
+    return jwt.encode(claims, private_key.save_pkcs1().decode(),
+                      algorithm='RS256', headers={'kid': kid})
+
+
+class FakeJWKSStore(JWKSStore):
+    ''' JWKSStore serving a canned key set instead of downloading it '''
+
+    def __init__(self, kids, max_age=None, **kwargs):
+        super().__init__('https://example.com/.well-known/jwks.json',
+                         **kwargs)
+        self.kids = kids
+        self.max_age = max_age
+        self.fetches = 0
+        self.gate = None
+
+    def _fetch(self):
+        if self.gate:
+            self.gate.wait()
+        self.fetches += 1
+        return {'keys': [make_jwk(kid) for kid in self.kids]}, self.max_age
+
+
+class JWKSStoreTestCase(unittest.TestCase):
+    ''' Test case for the in-process cache of the Auth0 key set '''
+
+    def test_parse_max_age(self):
+        self.assertEqual(parse_max_age('public, max-age=15'), 15)
+        self.assertEqual(parse_max_age('no-store'), 0)
+        self.assertIsNone(parse_max_age('public'))
+        self.assertIsNone(parse_max_age(None))
+
+    def test_key_set_is_fetched_once(self):
+        store = FakeJWKSStore(['a', 'b'])
+        for _ in range(10):
+            self.assertIsNotNone(store.get_key('a'))
+        self.assertEqual(store.fetches, 1)
+
+    def test_ttl_is_clamped(self):
+        store = FakeJWKSStore(['a'], max_age=5, min_ttl=60)
+        store.refresh()
+        self.assertGreaterEqual(store._expires_at - time.monotonic(), 59)
+
+    def test_unknown_kid_refetch_is_rate_limited(self):
+        store = FakeJWKSStore(['a'], refetch_interval=0)
+        store.get_key('a')
+        store.kids = ['a', 'b']  # key rotation on the issuer side
+        self.assertIsNotNone(store.get_key('b'))
+        self.assertEqual(store.fetches, 2)
+        self.assertEqual(store.version, 2)
+
+        store.refetch_interval = 60
+        self.assertIsNone(store.get_key('c'))
+        self.assertEqual(store.fetches, 2)
+
+    def test_stale_key_set_is_served_while_revalidating(self):
+        store = FakeJWKSStore(['a'])
+        store.get_key('a')
+        store._expires_at = 0  # expire the key set
+        store.kids = ['b']
+        store.gate = threading.Event()
+        # the stale key set is still served...
+        self.assertIsNotNone(store.get_key('a'))
+        self.assertEqual(store.fetches, 1)
+        # ...while the background refresh replaces it
+        store.gate.set()
+        for _ in range(100):
+            if store.fetches == 2 and not store._revalidating:
+                break
+            time.sleep(0.01)
+        self.assertEqual(store.fetches, 2)
+        self.assertIn('b', store.keys())
+
+    def test_keys_are_constructed_once_per_version(self):
+        store = FakeJWKSStore(['a'])
+        key = store.get_key('a')
+        self.assertIsInstance(key, store.key_class)
+        store.refresh()  # same key set
+        self.assertIs(store.get_key('a'), key)
+        store.kids = ['a', 'b']
+        store.refresh()
+        self.assertIsNot(store.get_key('a'), key)
+
+
+class FlakyJWKSFetcher(JWKSFetcher):
+    ''' JWKSFetcher whose downloads fail while `failing` is set '''
+
+    def __init__(self, **kwargs):
+        super().__init__('https://example.com/.well-known/jwks.json',
+                         **kwargs)
+        self.failing = True
+        self.downloads = 0
+
+    def _download(self):
+        self.downloads += 1
+        if self.failing:
+            raise IOError('JWKS download failed')
+        return {'keys': [make_jwk('a')]}, None
+
+
+class JWKSFetcherTestCase(unittest.TestCase):
+    ''' Test case for the timeouts and circuit breaker of the JWKS fetch '''
+
+    def test_read_timeout(self):
+        # a server accepting connections but never answering
+        server = socket.socket()
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        self.addCleanup(server.close)
+        port = server.getsockname()[1]
+        fetcher = JWKSFetcher(f'http://127.0.0.1:{port}/jwks.json',
+                              read_timeout=0.1)
+        start = time.monotonic()
+        with self.assertRaises(socket.timeout):
+            fetcher()
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(fetcher.stats()['errors'], 1)
+
+    def test_circuit_opens_after_repeated_failures(self):
+        fetcher = FlakyJWKSFetcher(failure_threshold=2, reset_timeout=60)
+        for _ in range(2):
+            with self.assertRaises(IOError):
+                fetcher()
+        self.assertEqual(fetcher.state, JWKSFetcher.OPEN)
+        with self.assertRaises(CircuitOpenError):
+            fetcher()
+        self.assertEqual(fetcher.downloads, 2)
+        self.assertEqual(fetcher.stats()['rejections'], 1)
+
+    def test_half_open_trial_closes_the_circuit(self):
+        fetcher = FlakyJWKSFetcher(failure_threshold=1, reset_timeout=0)
+        with self.assertRaises(IOError):
+            fetcher()
+        self.assertEqual(fetcher.state, JWKSFetcher.OPEN)
+        fetcher.failing = False
+        fetcher()
+        self.assertEqual(fetcher.state, JWKSFetcher.CLOSED)
+
+    def test_last_good_key_set_is_served(self):
+        fetcher = FlakyJWKSFetcher(failure_threshold=1, reset_timeout=60)
+        fetcher.failing = False
+        store = JWKSStore(fetcher.url, fetcher=fetcher, refetch_interval=0)
+        self.assertIsNotNone(store.get_key('a'))
+        fetcher.failing = True
+        store._expires_at = 0
+        # neither the unknown kid refetch nor the expiration lose the keys
+        self.assertIsNone(store.get_key('b'))
+        self.assertEqual(fetcher.state, JWKSFetcher.OPEN)
+        self.assertIsNotNone(store.get_key('a'))
+
+
+class JWKSRefresherTestCase(unittest.TestCase):
+    ''' Test case for the background refresh of the key set '''
+
+    def setUp(self):
+        # a key set expiring right away, refreshed every 10ms
+        self.store = FakeJWKSStore(['a'], max_age=0, min_ttl=0)
+        self.refresher = JWKSRefresher(self.store, lead=0, retry=0.01)
+        self.addCleanup(self.refresher.stop)
+
+    def wait_for_fetches(self, fetches):
+        for _ in range(100):
+            if self.store.fetches >= fetches:
+                return True
+            time.sleep(0.01)
+        return False
+
+    def test_key_set_is_kept_current(self):
+        self.assertTrue(self.store.warm_up())
+        self.refresher.start()
+        self.store.kids = ['a', 'b']
+        self.assertTrue(self.wait_for_fetches(3))
+        self.assertIn('b', self.store._keys)
+        self.assertEqual(self.refresher.stats()['errors'], 0)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), 'requires os.fork()')
+    def test_refresher_is_restarted_after_fork(self):
+        self.refresher.start()
+        self.assertTrue(self.wait_for_fetches(1))
+        pid = os.fork()
+        if pid == 0:  # child process
+            fetches = self.store.fetches
+            code = 0 if self.wait_for_fetches(fetches + 2) else 1
+            os._exit(code)
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.WEXITSTATUS(status), 0)
+
+
+@mock.patch.multiple(auth, AUTH0_DOMAIN='example.com', API_AUDIENCE='movie',
+                     ALGORITHMS=['RS256'])
+class VerifyDecodeJWTTestCase(unittest.TestCase):
+    ''' Test case for the token verification against the cached keys '''
+
+    def setUp(self):
+        self.claims = {
+            'iss': 'https://example.com/',
+            'aud': 'movie',
+            'exp': time.time() + 60,
+            'permissions': ['get:movies'],
+        }
+        self.store = FakeJWKSStore(['a', 'b'])
+        patcher = mock.patch.object(auth, 'jwks_store', self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_valid_token(self):
+        payload = auth.verify_decode_jwt(make_token('a', **self.claims))
+        self.assertEqual(payload['permissions'], ['get:movies'])
+
+    def test_invalid_signature(self):
+        # signed with key c but claiming to be signed with key a
+        token = make_token('c', **self.claims).split('.')
+        token[0] = make_token('a', **self.claims).split('.')[0]
+        with self.assertRaises(auth.AuthError) as error:
+            auth.verify_decode_jwt('.'.join(token))
+        self.assertEqual(error.exception.status_code, 400)
+
+    def test_unknown_kid(self):
+        with self.assertRaises(auth.AuthError) as error:
+            auth.verify_decode_jwt(make_token('c', **self.claims))
+        self.assertEqual(error.exception.error['description'],
+                         'Unable to find the appropriate key.')
+
+    def test_wrong_audience(self):
+        self.claims['aud'] = 'other'
+        with self.assertRaises(auth.AuthError) as error:
+            auth.verify_decode_jwt(make_token('a', **self.claims))
+        self.assertEqual(error.exception.error['code'], 'invalid_claims')
+
+    def test_expired_token(self):
+        self.claims['exp'] = time.time() - 60
+        with self.assertRaises(auth.AuthError) as error:
+            auth.verify_decode_jwt(make_token('a', **self.claims))
+        self.assertEqual(error.exception.error['code'], 'token_expired')
+
+
+@mock.patch.multiple(auth, AUTH0_DOMAIN='localhost', API_AUDIENCE='movie',
+                     ALGORITHMS=['RS256'])
+class LocalIssuerTestCase(unittest.TestCase):
+    ''' Test case for the tokens minted by the local issuer, checked against
+    its key set file '''
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        local_issuer.init(directory.name)
+        self.signing_key = local_issuer.load_signing_key(directory.name)
+        self.store = JWKSStore(
+            'unused',
+            fetcher=JWKSFileFetcher(os.path.join(directory.name,
+                                                 'jwks.json')))
+        patcher = mock.patch.object(auth, 'jwks_store', self.store)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_role_tokens(self):
+        for role, permissions in local_issuer.ROLE_PERMISSIONS.items():
+            token = local_issuer.mint_token(role, *self.signing_key,
+                                            domain='localhost',
+                                            audience='movie')
+            payload = auth.verify_decode_jwt(token)
+            self.assertEqual(payload['permissions'], permissions)
+        self.assertEqual(self.store.fetcher.stats()['fetches'], 1)
+
+    def test_expired_token(self):
+        token = local_issuer.mint_token('assistant', *self.signing_key,
+                                        expires_in=-60, domain='localhost',
+                                        audience='movie')
+        with self.assertRaises(auth.AuthError) as error:
+            auth.verify_decode_jwt(token)
+        self.assertEqual(error.exception.error['code'], 'token_expired')
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    ''' Test case for the cache of the verified tokens '''
+
+    def setUp(self):
+        auth.token_cache.clear()
+        self.payload = {'exp': time.time() + 60, 'permissions': []}
+
+    def test_lru_eviction(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)  # evicts b, the least recently used
+        self.assertEqual(cache.get('a'), 1)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.stats()['hits'], 2)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_entry_expiration(self):
+        cache = LRUCache()
+        cache.set('a', 1, expires_at=time.time() - 1)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+    def test_token_is_verified_once(self):
+        with mock.patch('app.auth.verify_decode_jwt',
+                        return_value=self.payload) as verify, \
+                mock.patch.object(auth.jwks_store, 'keys'):
+            for _ in range(10):
+                payload, granted = auth.verify_decode_jwt_cached('token')
+                self.assertEqual(payload, self.payload)
+                self.assertEqual(granted, 0)
+        self.assertEqual(verify.call_count, 1)
+
+    def test_expired_token_is_verified_again(self):
+        self.payload['exp'] = time.time() - 1
+        with mock.patch('app.auth.verify_decode_jwt',
+                        return_value=self.payload) as verify:
+            auth.verify_decode_jwt_cached('token')
+            auth.verify_decode_jwt_cached('token')
+        self.assertEqual(verify.call_count, 2)
+
+    def test_key_rotation_flushes_the_cache(self):
+        store = FakeJWKSStore(['a'])
+        store.listeners.append(auth.token_cache.clear)
+        store.refresh()
+        auth.token_cache.set(b'digest', self.payload)
+        store.refresh()  # same key set
+        self.assertEqual(len(auth.token_cache), 1)
+        store.kids = ['b']
+        store.refresh()
+        self.assertEqual(len(auth.token_cache), 0)
+
+
+class PermissionsTestCase(unittest.TestCase):
+    ''' Test case for the permissions bitmask checks '''
+
+    def test_permissions_mask(self):
+        payload = {'permissions': ['get:movies', 'get:actors', 'unknown']}
+        granted = auth.permissions_mask(payload)
+        self.assertEqual(granted, auth.PERMISSIONS['get:movies']
+                         | auth.PERMISSIONS['get:actors'])
+        self.assertIsNone(auth.permissions_mask({}))
+
+    def test_check_permissions(self):
+        payload = {'permissions': ['get:movies']}
+        self.assertTrue(auth.check_permissions('get:movies', payload))
+        with self.assertRaises(auth.AuthError) as error:
+            auth.check_permissions('delete:movies', payload)
+        self.assertEqual(error.exception.status_code, 401)
+        with self.assertRaises(auth.AuthError) as error:
+            auth.check_permissions('get:movies', {})
+        self.assertEqual(error.exception.status_code, 400)
+
+    def test_every_role_permission_is_known(self):
+        for permissions in local_issuer.ROLE_PERMISSIONS.values():
+            for permission in permissions:
+                self.assertIn(permission, auth.PERMISSIONS)
+
+    def test_unknown_route_permission_fails_at_startup(self):
+        with self.assertRaises(ValueError):
+            auth.requires_auth(permission='get:directors')
+
+
+if __name__ == '__main__':
+    unittest.main()
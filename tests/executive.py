@@ -246,6 +246,57 @@ class ExecutiveTestCase(unittest.TestCase):
         self.assertEqual(data['deleted'], movie.id)
         self.assertEqual(len(all_movies), self.total_movies)
 
+    def test_movie_4_bulk_add(self):
+        res = self.client().post(
+            '/movies/bulk',
+            data=json.dumps([
+                {'title': 'bulk one', 'release_date': '2000-01-01'},
+                {'release_date': '2000-01-01'},
+                {'title': 'bulk two'},
+            ]),
+            headers=[
+                ('Content-Type', 'application/json'),
+                ('Authorization', f'Bearer {self.jtw}')
+            ])
+        data = json.loads(res.data)
+        self.assertEqual(data['success'], True)
+        self.assertIsNone(data['added'][1])
+        self.assertEqual(data['errors'],
+                         [{'index': 1, 'errors': {'title': 'required'}}])
+        movies = [Movie.query.get(x) for x in data['added'][::2]]
+        self.assertEqual([x.title for x in movies], ['Bulk One', 'Bulk Two'])
+
+    def test_movie_5_bulk_update(self):
+        movies = Movie.query.filter(Movie.title.like('Bulk %')).all()
+        res = self.client().patch(
+            '/movies/bulk',
+            data=json.dumps([{'id': x.id, 'release_date': '2001-01-01'}
+                             for x in movies]),
+            headers=[
+                ('Content-Type', 'application/json'),
+                ('Authorization', f'Bearer {self.jtw}')
+            ])
+        data = json.loads(res.data)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['updated'], [x.id for x in movies])
+        self.assertEqual(data['errors'], [])
+
+    def test_movie_6_bulk_delete(self):
+        ids = [x.id for x in
+               Movie.query.filter(Movie.title.like('Bulk %')).all()]
+        res = self.client().delete(
+            '/movies/bulk',
+            data=json.dumps(ids + [0]),
+            headers=[
+                ('Content-Type', 'application/json'),
+                ('Authorization', f'Bearer {self.jtw}')
+            ])
+        data = json.loads(res.data)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(sorted(data['deleted']), sorted(ids))
+        self.assertEqual(data['not_found'], [0])
+        self.assertEqual(Movie.query.count(), self.total_movies)
+
     def test_delete_movie_not_found(self):
         res = self.client().delete('/movies/delete/0',
                                    headers=[
@@ -0,0 +1,17 @@
+''' WSGI app served by gunicorn in GreenTestCase: each request waits for the
+server at SLOW_URL, then tells how its worker was patched '''
+import json
+import os
+from urllib.request import urlopen
+
+
+def app(environ, start_response):
+    urlopen(os.environ['SLOW_URL']).read()
+    from gevent import monkey
+    from psycopg2 import extensions
+    body = json.dumps({
+        'socket': monkey.is_module_patched('socket'),
+        'psycopg2': extensions.get_wait_callback() is not None,
+    }).encode()
+    start_response('200 OK', [('Content-Type', 'application/json')])
+    return [body]
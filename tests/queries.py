@@ -0,0 +1,1089 @@
+import gzip
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+import zlib
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.request import urlopen
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import QueuePool
+
+from app import REPLICA_COOKIE, create_app
+from app.auth import PERMISSIONS
+from app.bulk import fill_defaults
+from app.config import engine_options
+from app.models import (db, Movie, Genre, Actor, Interpretation, movie_genre,
+                        dispose_pools)
+from app.notifications import VERSIONED_TABLES, listener, table_versions
+from app.search import load_results
+from app.serialization import dumps
+
+
+class SQLiteTestCase(unittest.TestCase):
+    ''' Base test case running the endpoints against an in-memory SQLite
+    database, bypassing the token verification '''
+
+    def setUp(self):
+        ''' Executed before each test function '''
+        self.app = create_app(testing=True)
+        self.client = self.app.test_client
+        self.context = self.app.app_context()
+        self.context.push()
+        db.create_all()
+
+        # every permission granted, without verifying any token
+        payload = {'permissions': list(PERMISSIONS)}
+        granted = sum(PERMISSIONS.values())
+        patcher = mock.patch('app.auth.verify_decode_jwt_cached',
+                             return_value=(payload, granted))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.headers = [('Authorization', 'Bearer token')]
+
+    def tearDown(self):
+        ''' Executed after each test function '''
+        db.session.remove()
+        db.drop_all()
+        self.context.pop()
+
+    def populate(self, size):
+        ''' Add size movies, each with 2 genres and 3 actors '''
+        genres = [Genre(name=f'genre {i}') for i in range(size)]
+        actors = [Actor(name=f'name {i}', surname=f'surname {i}',
+                        dob=datetime(1950, 1, 1), gender='female')
+                  for i in range(size)]
+        for i in range(size):
+            movie = Movie(title=f'movie {i}',
+                          release_date=datetime(2000, 1, 1))
+            movie.genre = [genres[i], genres[(i + 1) % size]]
+            for j in range(3):
+                db.session.add(Interpretation(
+                    movie=movie, actor=actors[(i + j) % size],
+                    character=f'character {i} {j}'))
+            db.session.add(movie)
+        db.session.commit()
+        db.session.expunge_all()  # nothing loaded before the request
+
+    @contextmanager
+    def count_queries(self):
+        ''' Count the queries executed within the context '''
+        queries = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            queries.append(statement)
+
+        engine = db.get_engine(self.app)
+        event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            yield queries
+        finally:
+            event.remove(engine, 'before_cursor_execute',
+                         before_cursor_execute)
+
+    def get(self, url):
+        ''' Return the number of queries run to serve url, and its data '''
+        db.session.expunge_all()
+        with self.count_queries() as queries:
+            res = self.client().get(url, headers=self.headers)
+        data = json.loads(res.data)
+        self.assertEqual(data['success'], True)
+        return len(queries), data
+
+
+class QueryCountTestCase(SQLiteTestCase):
+    ''' Test case pinning the number of SQL queries run by the read
+    endpoints, which must not grow with the size of the catalog '''
+
+    def assertConstantQueries(self, url, key):
+        ''' Check that serving url runs the same number of queries for a
+        small and a large catalog '''
+        self.populate(3)
+        small, data = self.get(url)
+        self.assertEqual(len(data[key]), 3)
+        self.populate(30)
+        large, data = self.get(url)
+        self.assertEqual(len(data[key]), 33)
+        self.assertEqual(small, large)
+        return large
+
+    # MOVIES -----------------------------------------------------------
+
+    def test_get_movies_queries(self):
+        queries = self.assertConstantQueries('/movies', 'movie')
+        self.assertLessEqual(queries, 3)
+
+    def test_get_movie_queries(self):
+        self.populate(3)
+        queries, data = self.get('/movies/1')
+        self.assertEqual(len(data['movie']['genre']), 2)
+        self.assertEqual(len(data['movie']['interpretation']), 3)
+        self.assertLessEqual(queries, 3)
+
+    # ACTORS -----------------------------------------------------------
+
+    def test_get_actors_queries(self):
+        queries = self.assertConstantQueries('/actors', 'actor')
+        self.assertLessEqual(queries, 2)
+
+    def test_get_actor_queries(self):
+        self.populate(3)
+        queries, data = self.get('/actors/1')
+        self.assertEqual(len(data['actor']['filmography']), 3)
+        self.assertLessEqual(queries, 2)
+
+    # GENRES -----------------------------------------------------------
+
+    def test_get_genres_queries(self):
+        queries = self.assertConstantQueries('/genres', 'genre')
+        self.assertLessEqual(queries, 2)
+
+    def test_get_genre_queries(self):
+        self.populate(3)
+        queries, data = self.get('/genres/1')
+        self.assertEqual(len(data['genre']['movies']), 2)
+        self.assertLessEqual(queries, 2)
+
+
+class PaginationTestCase(SQLiteTestCase):
+    ''' Test case for the keyset pagination of the list endpoints '''
+
+    def walk(self, url, key):
+        ''' Follow the next cursors from the first page of url, return the
+        pages '''
+        pages = []
+        cursor = None
+        while True:
+            page_url = url if cursor is None else f'{url}&after={cursor}'
+            _, data = self.get(page_url)
+            pages.append(data[key])
+            cursor = data['next']
+            if cursor is None:
+                return pages
+
+    def test_pages(self):
+        self.populate(7)
+        for url, key in (('/movies', 'movie'), ('/actors', 'actor'),
+                         ('/genres', 'genre')):
+            pages = self.walk(f'{url}?limit=3', key)
+            self.assertEqual([len(page) for page in pages], [3, 3, 1])
+
+    def test_last_full_page_has_no_next(self):
+        self.populate(6)
+        pages = self.walk('/movies?limit=3', 'movie')
+        self.assertEqual([len(page) for page in pages], [3, 3])
+        titles = [movie['title'] for page in pages for movie in page]
+        self.assertEqual(titles, [f'movie {i}' for i in range(6)])
+
+    def test_page_size_is_capped(self):
+        self.app.config['MAX_PAGE_SIZE'] = 2
+        self.populate(3)
+        _, data = self.get('/movies?limit=1000')
+        self.assertEqual(len(data['movie']), 2)
+        self.assertEqual(data['next'], 2)
+
+    def test_deep_page_queries(self):
+        self.populate(30)
+        first, _ = self.get('/movies?limit=5')
+        deep, data = self.get('/movies?limit=5&after=25')
+        self.assertEqual(len(data['movie']), 5)
+        self.assertIsNone(data['next'])
+        self.assertEqual(first, deep)
+
+    def test_invalid_page_args(self):
+        for url in ('/movies?limit=abc', '/movies?limit=0',
+                    '/movies?after=abc'):
+            res = self.client().get(url, headers=self.headers)
+            data = json.loads(res.data)
+            self.assertEqual(data['error'], 400)
+
+
+class FilteringTestCase(SQLiteTestCase):
+    ''' Test case for the genre and release date filters of the movies list,
+    and its sorting by release date '''
+
+    def setUp(self):
+        super().setUp()
+        crime, drama = Genre(name='Crime'), Genre(name='Drama')
+        # (title, release year, genres), the ids following the titles
+        for title, year, genres in (
+                ('m1', 1946, [crime]), ('m2', 1941, [crime, drama]),
+                ('m3', 1954, [drama]), ('m4', 1946, [drama, crime]),
+                ('m5', 1939, [crime]), ('m6', 1946, [crime])):
+            db.session.add(Movie(title=title,
+                                 release_date=datetime(year, 1, 1),
+                                 genre=genres))
+        db.session.commit()
+
+    def titles(self, url):
+        _, data = self.get(url)
+        return [movie['title'] for movie in data['movie']]
+
+    def test_filters(self):
+        self.assertEqual(self.titles('/movies?genre=Crime'),
+                         ['m1', 'm2', 'm4', 'm5', 'm6'])
+        self.assertEqual(self.titles('/movies?released_after=1946-01-01'),
+                         ['m1', 'm3', 'm4', 'm6'])
+        self.assertEqual(self.titles(
+            '/movies?genre=Crime&released_after=1940-01-01'
+            '&released_before=1950-01-01&sort=release_date'),
+            ['m2', 'm1', 'm4', 'm6'])
+        self.assertEqual(self.titles('/movies?genre=Western'), [])
+
+    def test_filtered_query(self):
+        with self.count_queries() as queries:
+            self.get('/movies?genre=Drama&released_before=1950-01-01'
+                     '&fields=title&sort=release_date')
+        self.assertEqual(len(queries), 1)
+
+    def test_sorted_pages(self):
+        titles = []
+        url = '/movies?sort=release_date&limit=2'
+        while url:
+            _, data = self.get(url)
+            titles += [movie['title'] for movie in data['movie']]
+            cursor = data['next']
+            url = cursor and '/movies?sort=release_date&limit=2' \
+                             f'&after={cursor}'
+        # the ties on the release date are broken by id
+        self.assertEqual(titles, ['m5', 'm2', 'm1', 'm4', 'm6', 'm3'])
+
+    def test_sorted_stream(self):
+        res = self.client().get('/movies?sort=release_date&stream=true'
+                                '&genre=Drama', headers=self.headers)
+        self.assertEqual([movie['title'] for movie in
+                          json.loads(res.data)['movie']], ['m2', 'm4', 'm3'])
+
+    def test_invalid_filter_args(self):
+        for url in ('/movies?released_after=1940',
+                    '/movies?released_before=yesterday',
+                    '/movies?sort=title',
+                    '/movies?sort=release_date&after=3'):
+            res = self.client().get(url, headers=self.headers)
+            self.assertEqual(json.loads(res.data)['error'], 400)
+
+
+class BulkCreateTestCase(SQLiteTestCase):
+    ''' Test case for the bulk creation of movies and actors '''
+
+    def post(self, url, body, mimetype='application/json'):
+        res = self.client().post(url, data=body, headers=self.headers,
+                                 content_type=mimetype)
+        return json.loads(res.data)
+
+    def test_json_array(self):
+        data = self.post('/movies/bulk', json.dumps([
+            {'title': 'the big sleep', 'release_date': '1946-08-31'},
+            {'title': '', 'release_date': 'soon'},
+            {'title': 'key largo', 'budget': 1},
+            {'title': 'sabrina'},
+        ]))
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['added'], [1, None, None, 2])
+        self.assertEqual(data['errors'], [
+            {'index': 1, 'errors': {
+                'title': 'must be a non-empty string',
+                'release_date': 'must be an ISO 8601 date'}},
+            {'index': 2, 'errors': {'budget': 'unknown field'}},
+        ])
+        movies = Movie.query.order_by(Movie.id).all()
+        self.assertEqual([x.title for x in movies],
+                         ['The Big Sleep', 'Sabrina'])
+        self.assertEqual(movies[0].release_date, datetime(1946, 8, 31))
+
+    def test_ndjson(self):
+        body = '\n'.join([
+            json.dumps({'name': 'lauren', 'surname': 'bacall',
+                        'dob': '1924-09-16', 'gender': 'female'}),
+            '{"name": "humphrey",',
+            '',
+            json.dumps({'name': 'humphrey', 'surname': 'bogart'}),
+        ])
+        data = self.post('/actors/bulk', body, 'application/x-ndjson')
+        self.assertEqual(data['added'], [1, None, 2])
+        self.assertEqual(data['errors'], [
+            {'index': 1, 'errors': {'row': 'must be a JSON object'}}])
+        self.assertEqual(Actor.query.get(2).surname, 'Bogart')
+
+    def test_column_defaults(self):
+        self.post('/movies/bulk', json.dumps([{'title': 'sabrina'}]))
+        self.post('/actors/bulk', json.dumps([{'name': 'humphrey',
+                                               'surname': 'bogart'}]))
+        self.client().post('/movies/add?title=casablanca',
+                           headers=self.headers)
+        bulk, single = Movie.query.order_by(Movie.id).all()
+        # as the single row endpoints do, rather than NULL
+        self.assertIsNotNone(bulk.release_date)
+        self.assertEqual(bulk.release_date, single.release_date)
+        self.assertEqual(Actor.query.get(1).dob,
+                         Actor.__table__.c.dob.default.arg)
+        self.assertEqual(fill_defaults(Movie.__table__, {
+            'title': 'Sabrina', 'release_date': None})['release_date'],
+            single.release_date)
+        _, data = self.get('/movies?sort=release_date')
+        self.assertEqual(len(data['movie']), 2)
+
+    def test_ids_in_order(self):
+        self.app.config['BULK_CHUNK_SIZE'] = 7
+        items = [{'title': f'movie {i}'} for i in range(50)]
+        data = self.post('/movies/bulk', json.dumps(items))
+        self.assertEqual(data['added'], list(range(1, 51)))
+        self.assertEqual(Movie.query.get(50).title, 'Movie 49')
+
+    def test_invalid_body(self):
+        self.app.config['BULK_MAX_ROWS'] = 2
+        for body in ('{"title": "casablanca"}', 'not json',
+                     json.dumps([{'title': 'x'}] * 3)):
+            data = self.post('/movies/bulk', body)
+            self.assertEqual(data['error'], 400)
+
+
+class BulkChangeTestCase(SQLiteTestCase):
+    ''' Test case for the bulk update and deletion of movies and actors '''
+
+    def send(self, method, url, items):
+        res = self.client().open(url, method=method, data=json.dumps(items),
+                                 headers=self.headers,
+                                 content_type='application/json')
+        return json.loads(res.data)
+
+    def test_update(self):
+        self.populate(3)
+        data = self.send('PATCH', '/movies/bulk', [
+            {'id': 3, 'title': 'the big sleep'},
+            {'id': 1, 'release_date': '1946-08-31'},
+            {'id': 9, 'title': 'missing'},
+            {'id': 1, 'title': 'twice'},
+            {'id': 2},
+            {'title': 'no id'},
+        ])
+        self.assertEqual(data['updated'], [3, 1])
+        self.assertEqual(data['errors'], [
+            {'index': 2, 'errors': {'id': 'not found'}},
+            {'index': 3, 'errors': {'id': 'duplicate id'}},
+            {'index': 4, 'errors': {'row': 'nothing to update'}},
+            {'index': 5, 'errors': {'id': 'must be an integer'}},
+        ])
+        movies = Movie.query.order_by(Movie.id).all()
+        self.assertEqual([x.title for x in movies],
+                         ['movie 0', 'movie 1', 'The Big Sleep'])
+        self.assertEqual(movies[0].release_date, datetime(1946, 8, 31))
+        self.assertEqual(movies[2].release_date, datetime(2000, 1, 1))
+
+    def test_delete_movies(self):
+        self.populate(3)
+        data = self.send('DELETE', '/movies/bulk', [2, 9, 2, 3])
+        self.assertEqual(data['deleted'], [2, 3])
+        self.assertEqual(data['not_found'], [9])
+        self.assertEqual([x.id for x in Movie.query], [1])
+        # the interpretations and genres of the deleted movies go with them
+        self.assertEqual({x.movie_id for x in Interpretation.query}, {1})
+        self.assertEqual(db.session.query(movie_genre).count(), 2)
+        self.assertEqual(Genre.query.count(), 3)
+
+    def test_delete_actors(self):
+        self.populate(3)
+        data = self.send('DELETE', '/actors/bulk', [1])
+        self.assertEqual(data['deleted'], [1])
+        self.assertEqual(Interpretation.query.count(), 6)
+        _, data = self.get('/movies/1')
+        self.assertEqual(len(data['movie']['interpretation']), 2)
+
+    def test_invalid_ids(self):
+        for ids in ([1, 'two'], [True], {'ids': [1]}):
+            data = self.send('DELETE', '/movies/bulk', ids)
+            self.assertEqual(data['error'], 400)
+
+
+class ResponseCacheTestCase(SQLiteTestCase):
+    ''' Test case for the per-worker cache of the read endpoints responses,
+    and its invalidation by the writes '''
+
+    def test_hit(self):
+        self.populate(3)
+        first, data = self.get('/movies?limit=2&fields=title')
+        self.assertGreater(first, 0)
+        # the same arguments in another order, served without any query
+        second, cached = self.get('/movies?fields=title&limit=2')
+        self.assertEqual(second, 0)
+        self.assertEqual(cached, data)
+        _, metrics = self.get('/metrics')
+        self.assertEqual(metrics['response_cache']['hits'], 1)
+        self.assertEqual(metrics['response_cache']['hit_rate'], 0.5)
+
+    def test_write_invalidates(self):
+        self.populate(3)
+        self.get('/actors/1')
+        self.client().patch('/actors/update/1?surname=bacall',
+                            headers=self.headers)
+        queries, data = self.get('/actors/1')
+        self.assertGreater(queries, 0)
+        self.assertEqual(data['actor']['surname'], 'Bacall')
+
+    def test_embedding_invalidated(self):
+        self.populate(3)
+        _, data = self.get('/actors/1')
+        self.assertIn('movie 0', data['actor']['filmography'])
+        self.client().open('/movies/bulk', method='PATCH',
+                           data=json.dumps([{'id': 1, 'title': 'casablanca'}]),
+                           headers=self.headers,
+                           content_type='application/json')
+        _, data = self.get('/actors/1')
+        self.assertIn('Casablanca', data['actor']['filmography'])
+        # a cast change reaches the movies through the interpretations
+        _, data = self.get('/movies/3')
+        self.client().open('/actors/bulk', method='DELETE', data='[1]',
+                           headers=self.headers,
+                           content_type='application/json')
+        _, data = self.get('/movies/3')
+        self.assertEqual(len(data['movie']['interpretation']), 2)
+
+    def test_rolled_back_write(self):
+        self.populate(3)
+        self.get('/genres')
+        db.session.add(Genre(name='western'))
+        db.session.flush()
+        db.session.rollback()
+        queries, _ = self.get('/genres')
+        self.assertEqual(queries, 0)
+
+    def test_write_outside_the_app(self):
+        self.populate(3)
+        self.get('/genres/1')
+        # as psql or a migration would
+        db.session.execute("UPDATE genres SET name = 'western' WHERE id = 1")
+        db.session.commit()
+        _, data = self.get('/genres/1')
+        self.assertEqual(data['genre']['name'], 'western')
+
+    def test_streams_not_cached(self):
+        self.populate(3)
+        self.client().get('/movies?stream=true', headers=self.headers)
+        res = self.client().get('/movies?stream=true', headers=self.headers)
+        self.assertTrue(res.is_streamed)
+
+    def test_expiry(self):
+        self.populate(3)
+        self.get('/genres/1')
+        ttl = self.app.config['RESPONSE_CACHE_TTL']
+        with mock.patch('app.cache.time.time',
+                        return_value=time.time() + ttl):
+            queries, _ = self.get('/genres/1')
+        self.assertGreater(queries, 0)
+
+
+class ConditionalRequestsTestCase(SQLiteTestCase):
+    ''' Test case for the ETags of the read endpoints, derived from the
+    table version counters '''
+
+    def conditional_get(self, url, etag):
+        db.session.expunge_all()
+        with self.count_queries() as queries:
+            res = self.client().get(url, headers=self.headers + [
+                ('If-None-Match', f'"{etag}"')])
+        return len(queries), res
+
+    def test_not_modified(self):
+        self.populate(3)
+        res = self.client().get('/movies', headers=self.headers)
+        etag, _ = res.get_etag()
+        self.assertTrue(etag)
+        self.assertIn('no-cache', res.headers['Cache-Control'])
+        self.assertIn('private', res.headers['Cache-Control'])
+        queries, res = self.conditional_get('/movies', etag)
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.data, b'')
+        self.assertEqual(res.get_etag(), (etag, False))
+        self.assertEqual(queries, 0)
+        _, metrics = self.get('/metrics')
+        self.assertEqual(metrics['response_cache']['not_modified'], 1)
+
+    def test_write_changes_etag(self):
+        self.populate(3)
+        etag, _ = self.client().get('/actors/1',
+                                    headers=self.headers).get_etag()
+        self.client().patch('/movies/update/1?title=casablanca',
+                            headers=self.headers)
+        queries, res = self.conditional_get('/actors/1', etag)
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.get_etag()[0], etag)
+        self.assertIn('Casablanca', json.loads(res.data)['actor']
+                                              ['filmography'])
+        # the genres do not embed the interpretations
+        etag, _ = self.client().get('/genres',
+                                    headers=self.headers).get_etag()
+        self.client().open('/actors/bulk', method='DELETE', data='[1]',
+                           headers=self.headers,
+                           content_type='application/json')
+        _, res = self.conditional_get('/genres', etag)
+        self.assertEqual(res.status_code, 304)
+
+    def test_etag_outlives_the_cache(self):
+        self.populate(3)
+        res = self.client().get('/movies/1', headers=self.headers)
+        etag, _ = res.get_etag()
+        self.assertTrue(etag.startswith(self.app.config['RELEASE'] + '-'))
+        # once the cached response expired, the same one is served again
+        with mock.patch('app.cache.time.time',
+                        return_value=time.time() + 3600):
+            _, expired = self.conditional_get('/movies/1', 'other')
+        self.assertEqual(expired.get_etag(), (etag, False))
+        self.assertEqual(expired.data, res.data)
+        # as psql, another dyno or a migration would
+        db.session.execute("UPDATE movies SET title = 'Casablanca'")
+        db.session.commit()
+        _, res = self.conditional_get('/movies/1', etag)
+        self.assertEqual(res.status_code, 200)
+        self.assertIn(b'Casablanca', res.data)
+
+    def test_versions_bumped_per_table(self):
+        self.populate(3)
+        before = table_versions.get(['movies', 'genres'])
+        db.session.add(Genre(name='western'))
+        db.session.flush()
+        # only once committed
+        self.assertEqual(table_versions.get(['movies', 'genres']), before)
+        db.session.commit()
+        after = table_versions.get(['movies', 'genres'])
+        self.assertEqual(after[0], before[0])
+        self.assertGreater(after[1], before[1])
+
+    def test_late_notification(self):
+        self.populate(3)
+        etag, _ = self.client().get('/genres',
+                                    headers=self.headers).get_etag()
+        version, = table_versions.get(['genres'])
+        # committed after a later version was notified: the responses read
+        # meanwhile miss it, the table gets a new version
+        listener.dispatch('table_versions', f'genres:{version - 1}')
+        self.assertGreater(table_versions.get(['genres'])[0], version)
+        _, res = self.conditional_get('/genres', etag)
+        self.assertEqual(res.status_code, 200)
+
+    def test_versions_unknown(self):
+        self.populate(3)
+        versions = table_versions.get(VERSIONED_TABLES)
+        self.addCleanup(table_versions.load,
+                        dict(zip(VERSIONED_TABLES, versions)))
+        # as while the listener reconnects: neither cached nor tagged
+        table_versions.load(None)
+        res = self.client().get('/movies', headers=self.headers)
+        self.assertIsNone(res.get_etag()[0])
+        queries, _ = self.get('/movies')
+        self.assertGreater(queries, 0)
+
+    def test_unversioned_table(self):
+        with self.assertRaises(KeyError):
+            table_versions.get(['unknown'])
+
+
+class CompressionTestCase(SQLiteTestCase):
+    ''' Test case for the negotiated compression of the responses '''
+
+    def fetch(self, url, accept_encoding='gzip', etag=None):
+        headers = self.headers + [('Accept-Encoding', accept_encoding)]
+        if etag:
+            headers.append(('If-None-Match', f'W/"{etag}"'))
+        return self.client().get(url, headers=headers)
+
+    def test_gzip(self):
+        self.populate(30)
+        plain = self.client().get('/movies', headers=self.headers)
+        self.assertNotIn('Content-Encoding', plain.headers)
+        res = self.fetch('/movies', 'br;q=0.5, gzip')
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        self.assertEqual(gzip.decompress(res.data), plain.data)
+        self.assertLess(len(res.data), len(plain.data) / 4)
+        # the compressed response only keeps a weak ETag, which validates
+        etag, weak = res.get_etag()
+        self.assertEqual((etag, weak), (plain.get_etag()[0], True))
+        res = self.fetch('/movies', etag=etag)
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.get_etag(), (etag, True))
+
+    def test_compressed_once(self):
+        self.populate(30)
+        first = self.fetch('/actors')
+        second = self.fetch('/actors')
+        self.assertEqual(first.data, second.data)
+        _, metrics = self.get('/metrics')
+        self.assertEqual(metrics['compression']['cache']['hits'], 1)
+
+    def test_not_compressed(self):
+        self.populate(30)
+        # below the threshold, not accepted, or refused
+        for url, accept_encoding in (('/movies/1', 'gzip'),
+                                     ('/movies', 'identity'),
+                                     ('/movies', 'gzip;q=0')):
+            res = self.fetch(url, accept_encoding)
+            self.assertNotIn('Content-Encoding', res.headers)
+            self.assertEqual(json.loads(res.data)['success'], True)
+
+    def test_streamed(self):
+        self.app.config['STREAM_BATCH_SIZE'] = 4
+        self.populate(30)
+        res = self.fetch('/actors?stream=true')
+        self.assertTrue(res.is_streamed)
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertNotIn('Content-Length', res.headers)
+        streamed = json.loads(gzip.decompress(res.data))
+        self.assertEqual(len(streamed['actor']), 30)
+
+    def test_streamed_before_the_end(self):
+        self.app.config['STREAM_BATCH_SIZE'] = 50
+        self.populate(300)
+        res = self.fetch('/actors?stream=true')
+        chunks = list(res.response)
+        res.close()
+        # the 10 bytes gzip header aside, the rows are sent as they come
+        # rather than all at once by the final flush
+        sent = [x for x in chunks[:-1] if len(x) > 10]
+        self.assertGreater(len(sent), 1)
+        decompressor = zlib.decompressobj(31)
+        first = decompressor.decompress(b''.join(chunks[:2]))
+        self.assertTrue(first.startswith(b'{"actor":[{'))
+        streamed = json.loads(gzip.decompress(b''.join(chunks)))
+        self.assertEqual(len(streamed['actor']), 300)
+
+
+class SerializationTestCase(SQLiteTestCase):
+    ''' Test case for the JSON serialization of the responses '''
+
+    def test_iso_dates(self):
+        self.populate(3)
+        _, data = self.get('/movies/1')
+        self.assertEqual(data['movie']['release_date'], '2000-01-01T00:00:00')
+        res = self.client().get('/actors?stream=true', headers=self.headers)
+        self.assertEqual(json.loads(res.data)['actor'][0]['dob'],
+                         '1950-01-01T00:00:00')
+
+    def test_stdlib_fallback(self):
+        obj = {'title': 'Casablanca', 'release_date': datetime(1942, 11, 26),
+               'genre': ['Drama', 'Romance'], 'budget': None}
+        for indent in (False, True):
+            fast = dumps(obj, indent=indent)
+            with mock.patch('app.serialization.orjson', None):
+                self.assertEqual(dumps(obj, indent=indent), fast)
+
+
+class MetricsTestCase(SQLiteTestCase):
+    ''' Test case for the access to the worker counters '''
+
+    def test_permission_required(self):
+        res = self.client().get('/metrics')
+        self.assertEqual(json.loads(res.data)['error'], 401)
+        payload = {'permissions': ['get:movies', 'get:actors']}
+        granted = PERMISSIONS['get:movies'] | PERMISSIONS['get:actors']
+        with mock.patch('app.auth.verify_decode_jwt_cached',
+                        return_value=(payload, granted)):
+            res = self.client().get('/metrics', headers=self.headers)
+        self.assertEqual(json.loads(res.data)['error'], 401)
+        _, metrics = self.get('/metrics')
+        self.assertIn('jwks', metrics)
+
+
+class ProductionConfigTestCase(unittest.TestCase):
+    ''' Test case for the settings required in production '''
+
+    def test_secret_key_required(self):
+        with mock.patch('app.config.Production.SECRET_KEY', None), \
+                self.assertRaises(RuntimeError):
+            create_app(production=True)
+
+
+class ConnectionPoolTestCase(unittest.TestCase):
+    ''' Test case for the connection pool settings and its fork safety '''
+
+    def setUp(self):
+        handle, path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+        self.engine = create_engine(f'sqlite:///{path}',
+                                    poolclass=QueuePool)
+        self.addCleanup(self.engine.dispose)
+
+    def test_engine_options(self):
+        with mock.patch.dict(os.environ, {'DB_POOL_SIZE': '20',
+                                          'DB_POOL_PRE_PING': 'false',
+                                          'DB_STATEMENT_TIMEOUT': '5000'}):
+            options = engine_options()
+        self.assertEqual(options['pool_size'], 20)
+        self.assertEqual(options['max_overflow'], 10)
+        self.assertFalse(options['pool_pre_ping'])
+        self.assertEqual(options['connect_args'], {
+            'connect_timeout': 5, 'options': '-c statement_timeout=5000'})
+
+    def test_inherited_connection_replaced(self):
+        connection = self.engine.raw_connection()
+        inherited = connection.connection
+        # as if opened by the parent of this process
+        connection._connection_record.info['pid'] = -1
+        connection.close()
+        connection = self.engine.raw_connection()
+        self.assertIsNot(connection.connection, inherited)
+        connection.close()
+
+    def test_idle_connections_closed_before_fork(self):
+        self.engine.execute('SELECT 1')
+        self.assertEqual(self.engine.pool.checkedin(), 1)
+        # only by gunicorn's hook, not by any fork of the process
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0)
+        os.waitpid(pid, 0)
+        self.assertEqual(self.engine.pool.checkedin(), 1)
+        dispose_pools()
+        self.assertEqual(self.engine.pool.checkedin(), 0)
+
+
+def importable(*modules):
+    ''' Tell whether every module can be imported '''
+    try:
+        for module in modules:
+            __import__(module)
+    except Exception:  # psycopg2 fails to initialize on some platforms
+        return False
+    return True
+
+
+class SlowHandler(BaseHTTPRequestHandler):
+    ''' Answer after SLOW_DELAY seconds, as a slow upstream would '''
+
+    def do_GET(self):
+        time.sleep(SLOW_DELAY)
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+SLOW_DELAY = 0.5
+
+
+@unittest.skipUnless(importable('gevent', 'gunicorn', 'psycopg2'),
+                     'requires gevent, gunicorn and psycopg2')
+class GreenTestCase(unittest.TestCase):
+    ''' Test case for the gevent workers, served by gunicorn with the
+    settings of gunicorn.conf.py '''
+
+    def serve(self, *args):
+        ''' Serve tests/green_app.py with gunicorn, return its URL '''
+        slow = ThreadingHTTPServer(('127.0.0.1', 0), SlowHandler)
+        threading.Thread(target=slow.serve_forever, daemon=True).start()
+        self.addCleanup(slow.server_close)
+        self.addCleanup(slow.shutdown)
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ, SLOW_URL=f'http://127.0.0.1:'
+                                        f'{slow.server_address[1]}/')
+        env.pop('WORKER_CLASS', None)
+        server = subprocess.Popen(
+            [sys.executable, '-c', 'from gunicorn.app.wsgiapp import run; '
+             'run()', '-c', 'gunicorn.conf.py',
+             '-b', f'127.0.0.1:{port}', *args, 'tests.green_app:app'],
+            cwd=root, env=env, stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL)
+        self.addCleanup(server.wait)
+        self.addCleanup(server.terminate)
+        deadline = time.monotonic() + 15
+        while time.monotonic() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', port), 1).close()
+                return f'http://127.0.0.1:{port}/'
+            except OSError:
+                time.sleep(0.1)
+        self.fail('gunicorn did not start')
+
+    def fetch(self, url, count):
+        ''' Send count concurrent requests to url, return the seconds they
+        took and their responses '''
+        responses = []
+
+        def get():
+            with urlopen(url, timeout=30) as res:
+                responses.append(json.loads(res.read()))
+        threads = [threading.Thread(target=get) for _ in range(count)]
+        start = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(responses), count)
+        return time.monotonic() - start, responses
+
+    def test_gevent_worker(self):
+        url = self.serve('-k', 'gevent')
+        self.fetch(url, 1)  # the worker is up
+        elapsed, responses = self.fetch(url, 8)
+        # a single worker waits for the 8 requests at once
+        self.assertLess(elapsed, 3 * SLOW_DELAY)
+        self.assertEqual(responses[0], {'socket': True, 'psycopg2': True})
+
+    def test_sync_worker_by_default(self):
+        url = self.serve()
+        self.fetch(url, 1)
+        elapsed, responses = self.fetch(url, 4)
+        self.assertGreaterEqual(elapsed, 4 * SLOW_DELAY)
+        self.assertEqual(responses[0], {'socket': False, 'psycopg2': False})
+
+    def test_wait_callback(self):
+        from psycopg2 import OperationalError, extensions
+        from app.green import wait_callback
+        connection = mock.Mock(fileno=mock.Mock(return_value=7))
+        connection.poll.side_effect = [extensions.POLL_WRITE,
+                                       extensions.POLL_READ,
+                                       extensions.POLL_OK]
+        with mock.patch('app.green.wait_read') as wait_read, \
+                mock.patch('app.green.wait_write') as wait_write:
+            wait_callback(connection)
+        wait_write.assert_called_once_with(7)
+        wait_read.assert_called_once_with(7)
+        connection.poll.side_effect = [-1]
+        with self.assertRaises(OperationalError):
+            wait_callback(connection)
+
+
+class ReplicaRoutingTestCase(SQLiteTestCase):
+    ''' Test case for the routing of the reads to a replica, but after the
+    recent writes '''
+
+    def setUp(self):
+        super().setUp()
+        handle, path = tempfile.mkstemp(suffix='.sqlite')
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+        self.app.config['SQLALCHEMY_BINDS'] = {'replica0': f'sqlite:///{path}'}
+        replica = db.get_engine(self.app, bind='replica0')
+        self.addCleanup(replica.dispose)
+        db.metadata.create_all(replica)
+        # the replica lags behind, with another title
+        replica.execute(Movie.__table__.insert(), title='Replica')
+        db.session.add(Movie(title='Primary'))
+        db.session.commit()
+        self.sticky = self.app.config['REPLICA_STICKY_SECONDS']
+
+        # an endpoint which is not cached
+        @self.app.route('/title')
+        def title():
+            return db.session.query(Movie.title).scalar()
+
+    def title(self, client=None):
+        ''' Return the title of the first movie '''
+        client = client or self.client()
+        return client.get('/title').data.decode()
+
+    def test_reads_routed(self):
+        later = time.time() + self.sticky
+        with mock.patch('time.time', return_value=later):
+            self.assertEqual(self.title(), 'Replica')
+        # writes go to the primary
+        with mock.patch('time.time', return_value=later):
+            self.client().patch('/movies/update/1?title=casablanca',
+                                headers=self.headers)
+        self.assertEqual(db.session.query(Movie.title).scalar(), 'Casablanca')
+
+    def test_read_your_writes(self):
+        writer = self.client()
+        writer.patch('/movies/update/1?title=casablanca',
+                     headers=self.headers)
+        self.assertEqual(self.title(writer), 'Casablanca')
+        self.assertEqual(self.title(), 'Replica')
+        # until the replica has caught up
+        later = time.time() + self.sticky + 1
+        with mock.patch('time.time', return_value=later):
+            self.assertEqual(self.title(writer), 'Replica')
+
+    def test_forged_cookie(self):
+        client = self.client()
+        client.set_cookie('localhost', REPLICA_COOKIE, 'primary.forged')
+        self.assertEqual(self.title(client), 'Replica')
+
+    def test_read_your_writes_without_cookies(self):
+        # bearer token clients, whose writes are notified by subject
+        payload = {'permissions': ['patch:movies'], 'sub': 'auth0|writer'}
+        granted = PERMISSIONS['patch:movies']
+        with mock.patch('app.auth.verify_decode_jwt_cached',
+                        return_value=(payload, granted)):
+            self.client(use_cookies=False).patch(
+                '/movies/update/1?title=casablanca', headers=self.headers)
+            res = self.client().get('/title', headers=self.headers)
+            self.assertEqual(res.data, b'Casablanca')
+            later = time.time() + self.sticky + 1
+            with mock.patch('time.time', return_value=later):
+                res = self.client().get('/title', headers=self.headers)
+            self.assertEqual(res.data, b'Replica')
+        # the other subjects read from the replicas
+        self.assertEqual(self.title(), 'Replica')
+
+    def test_cached_endpoints_read_the_primary(self):
+        # whose versions are the primary's ones
+        res = self.client().get('/movies/1?fields=title',
+                                headers=self.headers)
+        self.assertIn(b'Primary', res.data)
+
+    def test_no_replicas(self):
+        self.app.config['SQLALCHEMY_BINDS'] = {}
+        later = time.time() + self.sticky
+        with mock.patch('time.time', return_value=later):
+            self.assertEqual(self.title(), 'Primary')
+        res = self.client().patch('/movies/update/1?title=casablanca',
+                                  headers=self.headers)
+        self.assertNotIn('Set-Cookie', res.headers)
+
+
+class StreamingTestCase(SQLiteTestCase):
+    ''' Test case for the streamed full lists '''
+
+    def test_streamed_lists(self):
+        self.app.config['STREAM_BATCH_SIZE'] = 4
+        self.populate(10)
+        for url, key in (('/movies', 'movie'), ('/actors', 'actor'),
+                         ('/genres', 'genre')):
+            res = self.client().get(f'{url}?stream=true',
+                                    headers=self.headers)
+            self.assertTrue(res.is_streamed)
+            streamed = json.loads(res.data)
+            self.assertEqual(streamed['success'], True)
+            _, paginated = self.get(url)
+            self.assertEqual(streamed[key], paginated[key])
+
+    def test_streamed_empty_list(self):
+        res = self.client().get('/movies?stream=true', headers=self.headers)
+        self.assertEqual(json.loads(res.data), {'success': True, 'movie': []})
+
+    def test_streamed_error(self):
+        self.app.config['STREAM_BATCH_SIZE'] = 2
+        self.populate(5)
+        format = Movie.format
+
+        def failing(movie, fields=None):
+            if movie.id == 4:
+                raise RuntimeError
+            return format(movie, fields)
+        with mock.patch.object(Movie, 'format', failing), \
+                self.assertLogs(self.app.logger, 'ERROR'):
+            res = self.client().get('/movies?stream=true',
+                                    headers=self.headers)
+            data = json.loads(res.data)
+        # the rows sent before the error, then a trailer telling it
+        self.assertEqual(len(data['movie']), 3)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['error'], 500)
+
+
+class SparseFieldsetsTestCase(SQLiteTestCase):
+    ''' Test case for the fields and include arguments of the read
+    endpoints '''
+
+    def test_fields(self):
+        self.populate(3)
+        with self.count_queries() as queries:
+            _, data = self.get('/movies?fields=title')
+        self.assertEqual(data['movie'][0], {'title': 'movie 0'})
+        # a single query, not even selecting the release date
+        self.assertEqual(len(queries), 1)
+        self.assertNotIn('release_date', queries[0])
+
+    def test_include(self):
+        self.populate(3)
+        queries, data = self.get('/movies/1?include=interpretation')
+        self.assertEqual(set(data['movie']),
+                         {'title', 'release_date', 'interpretation'})
+        self.assertEqual(len(data['movie']['interpretation']), 3)
+        self.assertEqual(queries, 2)
+
+    def test_fields_and_include(self):
+        self.populate(3)
+        queries, data = self.get('/actors?fields=surname&include=filmography')
+        self.assertEqual(set(data['actor'][0]), {'surname', 'filmography'})
+        queries, data = self.get('/genres?include=')
+        self.assertEqual(data['genre'][0], {'name': 'genre 0'})
+        self.assertEqual(queries, 1)
+
+    def test_streamed_fields(self):
+        self.populate(3)
+        res = self.client().get('/actors?stream=true&fields=name',
+                                headers=self.headers)
+        data = json.loads(res.data)
+        self.assertEqual(data['actor'][2], {'name': 'name 2'})
+
+    def test_unknown_field(self):
+        res = self.client().get('/movies?fields=budget', headers=self.headers)
+        self.assertEqual(json.loads(res.data)['error'], 400)
+
+
+class SearchResultsTestCase(SQLiteTestCase):
+    ''' Test case for the loading of the ranked search results (the
+    full-text matching itself needs PostgreSQL, see tests/assistant.py) '''
+
+    def test_load_results(self):
+        self.populate(3)
+        matches = [('interpretation', 2, 0.9), ('movie', 3, 0.5),
+                   ('actor', 1, 0.4), ('movie', 99, 0.3), ('actor', 3, 0.1)]
+        with self.count_queries() as queries:
+            results = load_results(matches)
+        self.assertEqual(len(queries), 3)  # one per type
+        self.assertEqual([(x['type'], x['id']) for x in results],
+                         [('interpretation', 2), ('movie', 3), ('actor', 1),
+                          ('actor', 3)])  # the missing movie 99 is skipped
+        self.assertEqual(results[0]['interpretation'], {
+            'character': 'character 0 1',
+            'movie': 'movie 0',
+            'actor': 'name 1 surname 1',
+        })
+        self.assertEqual(results[1]['movie']['title'], 'movie 2')
+
+    def test_invalid_cursor(self):
+        for after in ('-1', '0.5,movie', 'nan,movie,1', '0.5,genre,1',
+                      '0.5,movie,x'):
+            res = self.client().get(f'/search?q=a&after={after}',
+                                    headers=self.headers)
+            self.assertEqual(json.loads(res.data)['error'], 400)
+
+    def test_cursor(self):
+        with mock.patch('app.full_text_search',
+                        return_value=([], (0.1, 'movie', 3))) as search:
+            _, data = self.get('/search?q=a&limit=5&after=0.5,actor,2')
+        search.assert_called_once_with(
+            'a', ['movie', 'actor', 'interpretation'], 5, (0.5, 'actor', 2))
+        self.assertEqual(data['next'], '0.1,movie,3')
+
+    def test_actors_permission(self):
+        payload = {'permissions': ['get:movies']}
+        with mock.patch('app.auth.verify_decode_jwt_cached',
+                        return_value=(payload, PERMISSIONS['get:movies'])), \
+                mock.patch('app.full_text_search',
+                           return_value=([], None)) as search:
+            self.get('/search?q=a')
+        self.assertEqual(search.call_args[0][1], ['movie'])
+
+
+class LookupArgsTestCase(SQLiteTestCase):
+    ''' Test case for the arguments of the fuzzy lookups (the trigram
+    matching itself needs PostgreSQL, see tests/assistant.py) '''
+
+    def test_invalid_lookup_args(self):
+        for url in ('/actors/lookup', '/actors/lookup?q=%20',
+                    '/movies/lookup?q=a&limit=0',
+                    '/movies/lookup?q=a&limit=abc',
+                    '/movies/lookup?q=a&threshold=2'):
+            res = self.client().get(url, headers=self.headers)
+            self.assertEqual(json.loads(res.data)['error'], 400)
+
+
+if __name__ == '__main__':
+    unittest.main()
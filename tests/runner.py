@@ -1,8 +1,10 @@
 import unittest
 
 from . import assistant
+from . import auth
 from . import director
 from . import executive
+from . import queries
 
 
 # initialize loader and suite of tests
@@ -11,8 +13,10 @@ suite = unittest.TestSuite()
 
 # load the tests into the suite
 suite.addTests(loader.loadTestsFromModule(assistant))
+suite.addTests(loader.loadTestsFromModule(auth))
 suite.addTests(loader.loadTestsFromModule(director))
 suite.addTests(loader.loadTestsFromModule(executive))
+suite.addTests(loader.loadTestsFromModule(queries))
 
 # initialize tests runner
 runner = unittest.TextTestRunner(verbosity=1)